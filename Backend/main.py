@@ -3,12 +3,19 @@
 # ---------------------------------------------------------
 
 import uvicorn
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse 
+from fastapi.responses import FileResponse, Response, StreamingResponse
 import os
+import json
+import hashlib
+import asyncio
 import shutil
+import tempfile
+import threading
+import socket
+import zipfile
 import cv2
 import logging
 import time
@@ -23,6 +30,22 @@ import supervision as sv
 import re, ast
 from fpdf import FPDF
 from datetime import datetime
+from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: file locks via msvcrt
+    fcntl = None
+    import msvcrt
+
+try:
+    import boto3
+    from botocore.exceptions import ClientError
+except ImportError:  # optional: only needed for ARTIFACT_BACKEND=s3
+    boto3 = None
+    ClientError = Exception
 
 # ---------------------------------------------------------
 # 1️⃣ APP SETUP
@@ -88,30 +111,1555 @@ app.mount("/panoramas", StaticFiles(directory=STITCHED_DIR), name="panoramas")
 app.mount("/compare_results", StaticFiles(directory=COMPARE_DIR), name="compare_results")
 
 
+# =========================================================
+# ☁️ Shared artifact storage (local disk or S3-compatible)
+# =========================================================
+# The folders above are always the node's working copy. With
+# ARTIFACT_BACKEND=s3 every artifact written by upload / stitch /
+# compare / PDF is also published to a shared bucket, and any node
+# fetches missing artifacts from it on demand, so API/inference nodes
+# stay stateless behind a load balancer.
+#
+# Local stand-in for testing (MinIO):
+#   docker run -p 9000:9000 -e MINIO_ROOT_USER=minio -e MINIO_ROOT_PASSWORD=minio123 \
+#       minio/minio server /data
+#   ARTIFACT_BACKEND=s3 S3_ENDPOINT_URL=http://localhost:9000 S3_BUCKET=construction-ai \
+#   AWS_ACCESS_KEY_ID=minio AWS_SECRET_ACCESS_KEY=minio123 python main.py
+#
+# Work distribution: expensive jobs (stitching a tour, producing a
+# comparison output) are guarded by leases stored in the same backend,
+# so exactly one node runs each job while the others wait for its result.
+# Locally a lease is an OS file lock (released by the kernel if the
+# process dies); on S3 it is an object renewed while the job runs and
+# taken over, via a conditional write, only once it has expired.
+
+ARTIFACT_BACKEND = os.getenv("ARTIFACT_BACKEND", "local").lower()   # "local" or "s3"
+NODE_ID = os.getenv("NODE_ID", f"{socket.gethostname()}-{os.getpid()}")
+LEASE_TTL_S = int(os.getenv("LEASE_TTL_S", "900"))
+LEASE_POLL_S = float(os.getenv("LEASE_POLL_S", "2"))
+LEASE_DIR = os.path.join(BASE_DIR, "locks")
+os.makedirs(LEASE_DIR, exist_ok=True)
+
+
+def _try_lock_file(fd: int):
+    """Non-blocking exclusive lock; raises OSError if another holder has it."""
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    else:
+        msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+
+
+def _unlock_file(fd: int):
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+    else:
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+
+
+class ArtifactStore:
+    """
+    Base class: artifacts are addressed by their local path; the shared
+    key is the path relative to BASE_DIR (e.g. temp_uploads/<tour>/frame-0.jpg).
+    Subclasses provide the storage primitives and job leases
+    (acquire_lease / renew_lease / release_lease).
+    """
+    remote = False
+
+    @staticmethod
+    def key(path: str):
+        return os.path.relpath(path, BASE_DIR).replace(os.sep, "/")
+
+
+class LocalArtifactStore(ArtifactStore):
+    """Single-node default: artifacts live only on local disk."""
+
+    def exists(self, path: str):
+        return os.path.exists(path)
+
+    def ensure_local(self, path: str):
+        return os.path.exists(path)
+
+    def publish(self, path: str):
+        pass
+
+    def delete(self, path: str):
+        pass
+
+    def list_dir(self, directory: str):
+        return []
+
+    # Leases are OS file locks, shared by every worker process on this
+    # node. The kernel drops them when the holder exits or crashes, so
+    # they never go stale and never need renewing or taking over.
+    def __init__(self):
+        self.held = {}
+        self.lock = threading.Lock()
+
+    def acquire_lease(self, job: str, ttl: int = LEASE_TTL_S):
+        fd = os.open(os.path.join(LEASE_DIR, f"{job}.lease"), os.O_CREAT | os.O_RDWR)
+        try:
+            _try_lock_file(fd)
+        except OSError:
+            os.close(fd)
+            return False
+        with self.lock:
+            self.held[job] = fd
+        return True
+
+    def renew_lease(self, job: str, ttl: int = LEASE_TTL_S):
+        return True
+
+    def release_lease(self, job: str):
+        with self.lock:
+            fd = self.held.pop(job, None)
+        if fd is not None:
+            _unlock_file(fd)
+            os.close(fd)
+
+
+class S3ArtifactStore(ArtifactStore):
+    """Shared bucket on S3 or any S3-compatible server (MinIO, Ceph, ...)."""
+    remote = True
+
+    def __init__(self, bucket: str, endpoint_url: str = None, prefix: str = ""):
+        if boto3 is None:
+            raise RuntimeError("ARTIFACT_BACKEND=s3 requires boto3 (pip install boto3)")
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client = boto3.client("s3", endpoint_url=endpoint_url)
+        self.leases = {}      # job → ETag of the lease object we wrote
+        self.lock = threading.Lock()
+
+    def object_key(self, path: str):
+        return self.prefix + self.key(path)
+
+    @staticmethod
+    def _missing(error):
+        return error.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound")
+
+    def exists(self, path: str):
+        if os.path.exists(path):
+            return True
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.object_key(path))
+            return True
+        except ClientError as e:
+            if self._missing(e):
+                return False
+            raise
+
+    def ensure_local(self, path: str):
+        """Downloads `path` from the bucket if this node has no copy."""
+        if os.path.exists(path):
+            return True
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".part"
+        try:
+            self.client.download_file(self.bucket, self.object_key(path), tmp_path)
+        except ClientError as e:
+            if self._missing(e):
+                return False
+            raise
+        os.replace(tmp_path, path)
+        logging.info(f"☁️ Fetched {self.key(path)} from shared storage")
+        return True
+
+    def publish(self, path: str):
+        self.client.upload_file(path, self.bucket, self.object_key(path))
+
+    def delete(self, path: str):
+        self.client.delete_object(Bucket=self.bucket, Key=self.object_key(path))
+
+    def list_dir(self, directory: str):
+        """Local paths of every object stored under `directory`."""
+        prefix = self.object_key(directory).rstrip("/") + "/"
+        paths = []
+        for page in self.client.get_paginator("list_objects_v2").paginate(Bucket=self.bucket, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                paths.append(os.path.join(BASE_DIR, *obj["Key"][len(self.prefix):].split("/")))
+        return paths
+
+    # Leases are objects under locks/ written with conditional puts:
+    # If-None-Match: * to create, If-Match: <etag> to renew or take over,
+    # so only one node can win any given version of a lease.
+    def lease_key(self, job: str):
+        return f"{self.prefix}locks/{job}"
+
+    @staticmethod
+    def _conflict(error):
+        return error.response.get("Error", {}).get("Code") in ("PreconditionFailed", "ConditionalRequestConflict")
+
+    def _put_lease(self, job: str, ttl: int, **condition):
+        """Writes our lease if `condition` holds; returns the new ETag or None."""
+        body = json.dumps({"node": NODE_ID, "expires": time.time() + ttl}).encode("utf-8")
+        try:
+            response = self.client.put_object(Bucket=self.bucket, Key=self.lease_key(job), Body=body, **condition)
+        except ClientError as e:
+            if self._conflict(e):
+                return None
+            raise
+        with self.lock:
+            self.leases[job] = response["ETag"]
+        return response["ETag"]
+
+    def acquire_lease(self, job: str, ttl: int = LEASE_TTL_S):
+        """Claims `job` for this node; an expired lease is replaced atomically."""
+        if self._put_lease(job, ttl, IfNoneMatch="*"):
+            return True
+        try:
+            obj = self.client.get_object(Bucket=self.bucket, Key=self.lease_key(job))
+        except ClientError as e:
+            if self._missing(e):
+                return False      # released meanwhile; retry on the next poll
+            raise
+        try:
+            expires = json.loads(obj["Body"].read().decode("utf-8")).get("expires", 0)
+        except ValueError:
+            expires = 0
+        if expires >= time.time():
+            return False
+        # Compare-and-swap on the expired version: at most one node takes over
+        if self._put_lease(job, ttl, IfMatch=obj["ETag"]):
+            logging.warning(f"⏰ Lease for {job} expired, taken over by {NODE_ID}")
+            return True
+        return False
+
+    def renew_lease(self, job: str, ttl: int = LEASE_TTL_S):
+        """Extends our lease; False if another node has taken it over."""
+        with self.lock:
+            etag = self.leases.get(job)
+        return etag is not None and self._put_lease(job, ttl, IfMatch=etag) is not None
+
+    def release_lease(self, job: str):
+        with self.lock:
+            etag = self.leases.pop(job, None)
+        if etag is None:
+            return
+        try:
+            head = self.client.head_object(Bucket=self.bucket, Key=self.lease_key(job))
+        except ClientError as e:
+            if self._missing(e):
+                return
+            raise
+        # Only delete the lease if it is still ours
+        if head["ETag"] == etag:
+            self.client.delete_object(Bucket=self.bucket, Key=self.lease_key(job))
+
+
+if ARTIFACT_BACKEND == "s3":
+    artifact_store = S3ArtifactStore(
+        bucket=os.getenv("S3_BUCKET", "construction-ai"),
+        endpoint_url=os.getenv("S3_ENDPOINT_URL"),
+        prefix=os.getenv("S3_PREFIX", ""),
+    )
+elif ARTIFACT_BACKEND == "local":
+    artifact_store = LocalArtifactStore()
+else:
+    raise ValueError(f"Unsupported ARTIFACT_BACKEND: {ARTIFACT_BACKEND}")
+
+logging.info(f"☁️ Artifact backend: {ARTIFACT_BACKEND} (node {NODE_ID})")
+
+
+def run_single_flight(job: str, is_done, work):
+    """
+    Runs `work()` on exactly one node/worker at a time.
+    If another node holds the lease, waits until `is_done()` and returns None.
+    """
+    while True:
+        if artifact_store.acquire_lease(job):
+            # Keep the lease alive for as long as the job runs
+            stop = threading.Event()
+
+            def heartbeat():
+                while not stop.wait(LEASE_TTL_S / 3):
+                    if not artifact_store.renew_lease(job):
+                        logging.warning(f"⚠️ Lost lease for {job} while it was still running")
+                        return
+
+            threading.Thread(target=heartbeat, name=f"lease-{job}", daemon=True).start()
+            try:
+                # The previous holder may have finished just before we got the lease
+                if is_done():
+                    return None
+                return work()
+            finally:
+                stop.set()
+                artifact_store.release_lease(job)
+        if is_done():
+            return None
+        time.sleep(LEASE_POLL_S)
+
+
+@app.middleware("http")
+async def fetch_shared_artifacts(request: Request, call_next):
+    """Pulls static files this node has not seen yet from shared storage."""
+    # HEAD too: the frontend probes panoramas with HEAD before showing them
+    if artifact_store.remote and request.method in ("GET", "HEAD"):
+        path = request.url.path
+        for prefix, directory in (("/uploads/", UPLOAD_DIR), ("/panoramas/", STITCHED_DIR),
+                                  ("/compare_results/", COMPARE_DIR)):
+            if path.startswith(prefix):
+                file_path = os.path.normpath(os.path.join(directory, *path[len(prefix):].split("/")))
+                if file_path.startswith(directory + os.sep) and not os.path.exists(file_path):
+                    await asyncio.get_running_loop().run_in_executor(None, artifact_store.ensure_local, file_path)
+                break
+    return await call_next(request)
+
+# =========================================================
+# 🖼️ Output image writer (background encoding)
+# =========================================================
+# Overlay images are encoded on a small thread pool (cv2.imencode
+# releases the GIL), so API responses do not wait for them.
+# Files are written atomically; requests for an image that is still
+# being encoded wait for it (see the middleware below).
+
+OUTPUT_IMAGE_FORMAT = os.getenv("OUTPUT_IMAGE_FORMAT", "jpg").lower()   # "jpg" or "webp"
+OUTPUT_IMAGE_QUALITY = int(os.getenv("OUTPUT_IMAGE_QUALITY", "95"))   # OpenCV default
+OUTPUT_JPEG_PROGRESSIVE = os.getenv("OUTPUT_JPEG_PROGRESSIVE", "1") == "1"
+OUTPUT_ENCODE_WORKERS = int(os.getenv("OUTPUT_ENCODE_WORKERS", "4"))
+
+if OUTPUT_IMAGE_FORMAT not in ("jpg", "webp"):
+    raise ValueError(f"Unsupported OUTPUT_IMAGE_FORMAT: {OUTPUT_IMAGE_FORMAT}")
+
+
+class ImageWriter:
+    """Encodes and saves images, either inline or on a thread pool."""
+
+    def __init__(self, workers: int):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image-writer")
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def encode_params(path: str):
+        ext = os.path.splitext(path)[1].lower()
+        if ext == ".webp":
+            return [cv2.IMWRITE_WEBP_QUALITY, OUTPUT_IMAGE_QUALITY]
+        if ext in (".jpg", ".jpeg"):
+            return [
+                cv2.IMWRITE_JPEG_QUALITY, OUTPUT_IMAGE_QUALITY,
+                cv2.IMWRITE_JPEG_PROGRESSIVE, int(OUTPUT_JPEG_PROGRESSIVE),
+                cv2.IMWRITE_JPEG_OPTIMIZE, 1,
+            ]
+        return []
+
+    def write(self, path: str, image):
+        """Encodes `image` and atomically replaces `path` (blocking)."""
+        ok, buffer = cv2.imencode(os.path.splitext(path)[1], image, self.encode_params(path))
+        if not ok:
+            raise ValueError(f"Could not encode image for {path}")
+        tmp_path = path + ".part"
+        with open(tmp_path, "wb") as f:
+            f.write(buffer.tobytes())
+        os.replace(tmp_path, path)
+        artifact_store.publish(path)
+
+    def submit(self, path: str, image):
+        """
+        Queues `image` for background encoding and returns immediately.
+        The caller must not modify `image` afterwards.
+        """
+        key = os.path.normpath(path)
+        future = self.executor.submit(self.write, path, image)
+        with self.lock:
+            self.pending[key] = future
+        future.add_done_callback(lambda f, key=key: self._done(key, f))
+        return future
+
+    def _done(self, key: str, future):
+        with self.lock:
+            if self.pending.get(key) is future:
+                del self.pending[key]
+        if future.exception() is not None:
+            logging.error(f"❌ Failed to write {key}: {future.exception()}")
+
+    def is_pending(self, path: str):
+        with self.lock:
+            return os.path.normpath(path) in self.pending
+
+    def wait(self, paths):
+        """Blocks until the given paths (if queued) have been written."""
+        with self.lock:
+            futures = [self.pending.get(os.path.normpath(p)) for p in paths]
+        for future in futures:
+            if future is not None:
+                future.exception()
+
+
+image_writer = ImageWriter(OUTPUT_ENCODE_WORKERS)
+
+
+@app.middleware("http")
+async def wait_for_pending_images(request: Request, call_next):
+    """Holds /compare_results requests until a queued image is on disk."""
+    path = request.url.path
+    if path.startswith("/compare_results/"):
+        file_path = os.path.join(COMPARE_DIR, *path[len("/compare_results/"):].split("/"))
+        if image_writer.is_pending(file_path):
+            await asyncio.get_running_loop().run_in_executor(None, image_writer.wait, [file_path])
+    return await call_next(request)
+
+
+@app.on_event("shutdown")
+def flush_image_writer():
+    image_writer.executor.shutdown(wait=True)
+
+
+# =========================================================
+# 🗃️ Tour frame store (manifest + frame index)
+# =========================================================
+# Each tour folder keeps a manifest.json next to its frames:
+#   {"tour_id": ..., "frames": [{"index": 0, "filename": "frame-0.jpg", "size": ...}, ...]}
+# The manifest is updated on upload, so stitching reads the ordered
+# frame list without listing and parsing the directory every time.
+# Only .jpg files are frames. Every read-modify-write of a manifest holds
+# manifest_lock(tour_id), an OS file lock shared by all worker processes.
+
+FRAME_MANIFEST = "manifest.json"
+
+
+@contextmanager
+def manifest_lock(tour_id: str):
+    """Exclusive access to one tour's manifest (across threads and worker processes)."""
+    fd = os.open(os.path.join(LEASE_DIR, f"manifest-{tour_id}.lock"), os.O_CREAT | os.O_RDWR)
+    try:
+        while True:
+            try:
+                _try_lock_file(fd)
+                break
+            except OSError:
+                time.sleep(0.01)
+        try:
+            yield
+        finally:
+            _unlock_file(fd)
+    finally:
+        os.close(fd)
+
+
+def frame_index(filename: str):
+    """frame-12.jpg → 12 (None if the name has no numeric suffix)."""
+    try:
+        return int(os.path.splitext(filename)[0].split('-')[1])
+    except (IndexError, ValueError):
+        return None
+
+
+def _sort_frames(frames):
+    # Numbered frames first (by index), anything else by filename
+    return sorted(frames, key=lambda fr: (fr["index"] is None, fr["index"] or 0, fr["filename"]))
+
+
+def read_tour_manifest(tour_id: str):
+    """Returns the tour manifest, rebuilding it from the folder if missing or unreadable."""
+    tour_dir = os.path.join(UPLOAD_DIR, tour_id)
+    manifest_path = os.path.join(tour_dir, FRAME_MANIFEST)
+    try:
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        pass
+
+    frames = {
+        f: {"index": frame_index(f), "filename": f, "size": os.path.getsize(os.path.join(tour_dir, f))}
+        for f in os.listdir(tour_dir)
+        if f.endswith(".jpg")
+    }
+    manifest = {"tour_id": tour_id}
+
+    # Frames already packed by compact_tour_frames
+    archive_path = os.path.join(tour_dir, FRAME_ARCHIVE)
+    if os.path.exists(archive_path):
+        with zipfile.ZipFile(archive_path) as zf:
+            for info in zf.infolist():
+                frames.setdefault(info.filename, {"index": frame_index(info.filename),
+                                                  "filename": info.filename, "size": info.file_size})
+        manifest["archive"] = FRAME_ARCHIVE
+
+    manifest["frames"] = _sort_frames(list(frames.values()))
+    write_tour_manifest(tour_id, manifest)
+    return manifest
+
+
+def write_tour_manifest(tour_id: str, manifest: dict):
+    tour_dir = os.path.join(UPLOAD_DIR, tour_id)
+    tmp_path = os.path.join(tour_dir, f".{FRAME_MANIFEST}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, os.path.join(tour_dir, FRAME_MANIFEST))
+
+
+def register_frame(tour_id: str, filename: str):
+    """Adds (or refreshes) one frame in the tour manifest. Non-.jpg files are not frames."""
+    if not filename.endswith(".jpg"):
+        return
+    tour_dir = os.path.join(UPLOAD_DIR, tour_id)
+    with manifest_lock(tour_id):
+        manifest = read_tour_manifest(tour_id)
+        frames = [fr for fr in manifest["frames"] if fr["filename"] != filename]
+        frames.append({
+            "index": frame_index(filename),
+            "filename": filename,
+            "size": os.path.getsize(os.path.join(tour_dir, filename)),
+        })
+        manifest["frames"] = _sort_frames(frames)
+        write_tour_manifest(tour_id, manifest)
+
+
+def add_next_frame(tour_id: str, save):
+    """
+    Allocates the next free frame index of a tour, calls `save(file_path)`
+    to write frame-<n>.jpg and registers it, all under the manifest lock,
+    so concurrent writers never pick the same index. Returns the filename.
+    """
+    tour_dir = os.path.join(UPLOAD_DIR, tour_id)
+    with manifest_lock(tour_id):
+        manifest = read_tour_manifest(tour_id)
+        index = max((fr["index"] for fr in manifest["frames"] if fr["index"] is not None), default=-1) + 1
+        filename = f"frame-{index}.jpg"
+        file_path = os.path.join(tour_dir, filename)
+        save(file_path)
+        manifest["frames"] = _sort_frames(manifest["frames"] + [
+            {"index": index, "filename": filename, "size": os.path.getsize(file_path)},
+        ])
+        write_tour_manifest(tour_id, manifest)
+    return filename
+
+
 # =========================================================
 # 🔹 Get all uploaded image files for a tour
 # =========================================================
-def get_tour_files(tour_id: str):
+def sync_tour_frames(tour_id: str):
+    """Downloads frames other nodes uploaded for this tour and refreshes the manifest."""
+    tour_dir = os.path.join(UPLOAD_DIR, tour_id)
+    remote = [p for p in artifact_store.list_dir(tour_dir)
+              if p.endswith(".jpg") or os.path.basename(p) == FRAME_ARCHIVE]
+    missing = [p for p in remote if not os.path.exists(p)]
+    if not missing:
+        return
+    for path in missing:
+        artifact_store.ensure_local(path)
+    with manifest_lock(tour_id):
+        try:
+            os.remove(os.path.join(tour_dir, FRAME_MANIFEST))
+        except FileNotFoundError:
+            pass
+        read_tour_manifest(tour_id)
+
+
+def get_tour_files(tour_id: str, sync: bool = True):
     """
     Returns all image file paths for the given tour_id, sorted by frame number.
     Expected naming: frame-0.jpg, frame-1.jpg, ...
+    With shared storage, frames uploaded to other nodes are fetched first
+    (unless sync=False).
     """
     tour_dir = os.path.join(UPLOAD_DIR, tour_id)
+    if sync and artifact_store.remote:
+        sync_tour_frames(tour_id)
     if not os.path.isdir(tour_dir):
         return []
 
+    with manifest_lock(tour_id):
+        manifest = read_tour_manifest(tour_id)
+    return [os.path.join(tour_dir, fr["filename"]) for fr in manifest["frames"]]
+
+
+# =========================================================
+# 🗃️ Decoded panorama cache (memory-mapped raw arrays)
+# =========================================================
+# Panoramas are decoded from JPEG once and kept as raw .npy arrays.
+# Loading maps the file copy-on-write: pages are shared between every
+# stage (and every request) and nothing is copied unless a stage writes.
+
+PANORAMA_CACHE_DIR = os.path.join(BASE_DIR, "panorama_cache")
+os.makedirs(PANORAMA_CACHE_DIR, exist_ok=True)
+
+
+def panorama_path(tour_id: str):
+    return os.path.join(STITCHED_DIR, f"{tour_id}_panorama.jpg")
+
+
+def cache_panorama(tour_id: str, image):
+    """Stores an already-decoded panorama in the raw cache."""
+    cache_path = os.path.join(PANORAMA_CACHE_DIR, f"{tour_id}.npy")
+    tmp_path = cache_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, np.ascontiguousarray(image))
+    os.replace(tmp_path, cache_path)
+
+
+def load_panorama(tour_id: str):
+    """
+    Returns the decoded panorama for a tour as a copy-on-write memmap.
+    Decodes the JPEG (and fills the cache) only when the cache is
+    missing or older than the panorama file. Returns None if unreadable.
+    """
+    jpg_path = panorama_path(tour_id)
+    cache_path = os.path.join(PANORAMA_CACHE_DIR, f"{tour_id}.npy")
+
+    if not artifact_store.ensure_local(jpg_path):
+        return None
+
+    storage_manager.touch(jpg_path)
+    storage_manager.touch(cache_path)
+    if not os.path.exists(cache_path) or os.path.getmtime(cache_path) < os.path.getmtime(jpg_path):
+        image = cv2.imread(jpg_path)
+        if image is None:
+            return None
+        cache_panorama(tour_id, image)
+        logging.info(f"🗃️ Cached decoded panorama for {tour_id}")
+
+    try:
+        # Plain ndarray view over the mapping (avoids memmap subclass quirks downstream)
+        return np.asarray(np.load(cache_path, mmap_mode="c"))
+    except (OSError, ValueError) as e:
+        logging.warning(f"⚠️ Panorama cache unreadable for {tour_id} ({e}), decoding JPEG instead.")
+        return cv2.imread(jpg_path)
+
+# =========================================================
+# 🧹 Storage lifecycle manager (quotas + LRU eviction)
+# =========================================================
+# Every storage folder gets a byte quota (0 = unlimited). When a folder
+# is over quota, its least recently used artifacts are evicted:
+#   compare_results / panorama_cache → always (rebuilt on demand)
+#   stitched_panoramas               → only if the tour's frames still exist
+#                                      (stitch status records never)
+#   temp_uploads (per tour)          → only if the tour's panorama exists
+# Last access times are tracked by the API (file mtime as a fallback).
+
+STORAGE_INDEX_PATH = os.path.join(BASE_DIR, "storage_access.json")
+STORAGE_COMPACT_FRAMES = os.getenv("STORAGE_COMPACT_FRAMES", "0") == "1"
+STORAGE_MIN_AGE_S = int(os.getenv("STORAGE_MIN_AGE_S", "300"))
+STORAGE_ENFORCE_INTERVAL_S = int(os.getenv("STORAGE_ENFORCE_INTERVAL_S", "60"))
+
+MB = 1024 * 1024
+STORAGE_QUOTAS = {
+    "temp_uploads": (UPLOAD_DIR, int(os.getenv("STORAGE_QUOTA_UPLOADS_MB", "0")) * MB),
+    "stitched_panoramas": (STITCHED_DIR, int(os.getenv("STORAGE_QUOTA_PANORAMAS_MB", "0")) * MB),
+    "compare_results": (COMPARE_DIR, int(os.getenv("STORAGE_QUOTA_COMPARE_MB", "2048")) * MB),
+    "panorama_cache": (PANORAMA_CACHE_DIR, int(os.getenv("STORAGE_QUOTA_CACHE_MB", "4096")) * MB),
+}
+
+FRAME_ARCHIVE = "frames.zip"
+
+
+def _tour_has_frames(tour_id: str):
+    return len(get_tour_files(tour_id, sync=False)) > 0
+
+
+def _dir_size_and_mtime(path: str):
+    size, mtime = 0, os.path.getmtime(path)
+    for root, _, files in os.walk(path):
+        for name in files:
+            st = os.stat(os.path.join(root, name))
+            size += st.st_size
+            mtime = max(mtime, st.st_mtime)
+    return size, mtime
+
+
+class StorageManager:
+    """Tracks artifact sizes / last access and enforces per-folder quotas."""
+
+    def __init__(self, quotas: dict, min_age: int):
+        self.quotas = quotas
+        self.min_age = min_age
+        self.access = {}
+        self.lock = threading.Lock()
+        self.enforce_lock = threading.Lock()
+        self.last_enforced = 0.0
+        self.load_index()
+
+    # --- access tracking ---
+    def load_index(self):
+        try:
+            with open(STORAGE_INDEX_PATH, "r", encoding="utf-8") as f:
+                self.access = json.load(f)
+        except (OSError, ValueError):
+            self.access = {}
+
+    def save_index(self):
+        with self.lock:
+            snapshot = dict(self.access)
+        tmp_path = STORAGE_INDEX_PATH + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, STORAGE_INDEX_PATH)
+
+    def touch(self, path: str):
+        with self.lock:
+            self.access[os.path.normpath(path)] = time.time()
+
+    def last_access(self, path: str, mtime: float):
+        with self.lock:
+            return max(self.access.get(os.path.normpath(path), 0.0), mtime)
+
+    # --- artifact listing ---
+    def artifacts(self, name: str):
+        """Lists artifacts of one storage folder with size, last access and evictability."""
+        directory, _ = self.quotas[name]
+        items = []
+
+        if name == "temp_uploads":
+            for entry in os.scandir(directory):
+                if not entry.is_dir():
+                    continue
+                size, mtime = _dir_size_and_mtime(entry.path)
+                items.append({
+                    "path": entry.path,
+                    "size": size,
+                    "last_access": self.last_access(entry.path, mtime),
+                    # With shared storage every local copy can be fetched again
+                    "evictable": artifact_store.remote or os.path.exists(panorama_path(entry.name)),
+                })
+            return items
+
+        for root, _, files in os.walk(directory):
+            for filename in files:
+                path = os.path.join(root, filename)
+                if filename.endswith((".part", ".tmp")) or image_writer.is_pending(path):
+                    continue
+                st = os.stat(path)
+                if name == "stitched_panoramas" and filename.endswith("_panorama.json"):
+                    # Stitch status records are tiny; evicting a failure record would re-run the failing ladder
+                    evictable = False
+                elif name == "stitched_panoramas" and not artifact_store.remote:
+                    # <tour>_panorama*.jpg and <tour>_preview.jpg can be rebuilt from the frames
+                    evictable = _tour_has_frames(re.sub(r"_(panorama|preview).*$", "", filename))
+                else:
+                    evictable = True
+                items.append({
+                    "path": path,
+                    "size": st.st_size,
+                    "last_access": self.last_access(path, st.st_mtime),
+                    "evictable": evictable,
+                })
+        return items
+
+    def usage(self):
+        stats = {}
+        for name, (directory, quota) in self.quotas.items():
+            items = self.artifacts(name)
+            used = sum(item["size"] for item in items)
+            stats[name] = {
+                "directory": directory,
+                "used_bytes": used,
+                "quota_bytes": quota,
+                "usage_percent": round(100 * used / quota, 1) if quota else None,
+                "artifacts": len(items),
+                "evictable_artifacts": sum(1 for item in items if item["evictable"]),
+                "oldest_access": min((item["last_access"] for item in items), default=None),
+            }
+        return stats
+
+    # --- eviction ---
+    def evict(self, path: str):
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.exists(path):
+            os.remove(path)
+        with self.lock:
+            self.access.pop(os.path.normpath(path), None)
+
+    def enforce(self):
+        """Evicts least recently used artifacts until every folder is within quota."""
+        evicted = []
+        with self.enforce_lock:
+            now = time.time()
+            for name, (_, quota) in self.quotas.items():
+                if not quota:
+                    continue
+                items = self.artifacts(name)
+                used = sum(item["size"] for item in items)
+                if used <= quota:
+                    continue
+                for item in sorted(items, key=lambda it: it["last_access"]):
+                    if used <= quota:
+                        break
+                    if not item["evictable"] or now - item["last_access"] < self.min_age:
+                        continue
+                    self.evict(item["path"])
+                    used -= item["size"]
+                    evicted.append({"folder": name, "path": os.path.relpath(item["path"], BASE_DIR),
+                                    "size": item["size"]})
+                if used > quota:
+                    logging.warning(f"⚠️ {name} still over quota after eviction ({used / MB:.0f} MB)")
+            self.last_enforced = now
+            self.save_index()
+
+        for item in evicted:
+            logging.info(f"🧹 Evicted {item['path']} ({item['size'] / MB:.1f} MB)")
+        return evicted
+
+    def enforce_in_background(self):
+        """Runs `enforce` on a worker thread, at most once per interval."""
+        if time.time() - self.last_enforced < STORAGE_ENFORCE_INTERVAL_S or self.enforce_lock.locked():
+            return
+        threading.Thread(target=self.enforce, name="storage-enforce", daemon=True).start()
+
+
+storage_manager = StorageManager(STORAGE_QUOTAS, STORAGE_MIN_AGE_S)
+
+# Static URL prefix → folder, for access tracking
+STATIC_PREFIXES = {
+    "/uploads/": UPLOAD_DIR,
+    "/panoramas/": STITCHED_DIR,
+    "/compare_results/": COMPARE_DIR,
+}
+
+
+@app.middleware("http")
+async def track_artifact_access(request: Request, call_next):
+    """Records last access for files served from the static mounts."""
+    path = request.url.path
+    for prefix, directory in STATIC_PREFIXES.items():
+        if path.startswith(prefix):
+            parts = path[len(prefix):].split("/")
+            # Uploads are tracked per tour folder
+            if directory == UPLOAD_DIR:
+                parts = parts[:1]
+            file_path = os.path.join(directory, *parts)
+            if os.path.exists(file_path):
+                storage_manager.touch(file_path)
+            break
+    return await call_next(request)
+
+
+@app.on_event("shutdown")
+def save_storage_index():
+    storage_manager.save_index()
+
+
+# ---------------------------------------------------------
+# Frame compaction
+# ---------------------------------------------------------
+def compact_tour_frames(tour_id: str):
+    """
+    Packs a tour's loose frame JPEGs into a single frames.zip (stored,
+    no re-encoding) and removes the loose files; their /uploads URLs are
+    then answered from the archive (serve_compacted_frames). Returns frames packed.
+    """
+    tour_dir = os.path.join(UPLOAD_DIR, tour_id)
+    with manifest_lock(tour_id):
+        manifest = read_tour_manifest(tour_id)
+        loose = [fr for fr in manifest["frames"] if os.path.exists(os.path.join(tour_dir, fr["filename"]))]
+        if not loose:
+            return 0
+
+        with zipfile.ZipFile(os.path.join(tour_dir, FRAME_ARCHIVE), "a", compression=zipfile.ZIP_STORED) as zf:
+            for fr in loose:
+                zf.write(os.path.join(tour_dir, fr["filename"]), arcname=fr["filename"])
+
+        manifest["archive"] = FRAME_ARCHIVE
+        write_tour_manifest(tour_id, manifest)
+        artifact_store.publish(os.path.join(tour_dir, FRAME_ARCHIVE))
+        for fr in loose:
+            os.remove(os.path.join(tour_dir, fr["filename"]))
+            artifact_store.delete(os.path.join(tour_dir, fr["filename"]))
+
+    logging.info(f"🗜️ Compacted {len(loose)} frames for {tour_id}")
+    return len(loose)
+
+
+def load_tour_frames(tour_id: str):
+    """Decodes every frame of a tour in order, from loose files or the compacted archive."""
+    tour_dir = os.path.join(UPLOAD_DIR, tour_id)
+    image_files = get_tour_files(tour_id)
+    archive_path = os.path.join(tour_dir, FRAME_ARCHIVE)
+    archive = zipfile.ZipFile(archive_path) if os.path.exists(archive_path) else None
+    storage_manager.touch(tour_dir)
+
     try:
-        files = sorted(
-            [os.path.join(tour_dir, f) for f in os.listdir(tour_dir) if f.endswith(".jpg")],
-            key=lambda x: int(os.path.splitext(os.path.basename(x))[0].split('-')[1])
+        images = []
+        for path in image_files:
+            if os.path.exists(path):
+                images.append(cv2.imread(path))
+            elif archive is not None:
+                data = np.frombuffer(archive.read(os.path.basename(path)), np.uint8)
+                images.append(cv2.imdecode(data, cv2.IMREAD_COLOR))
+            else:
+                images.append(None)
+        return images
+    finally:
+        if archive is not None:
+            archive.close()
+
+
+def read_archived_frame(tour_id: str, filename: str):
+    """Bytes of a frame packed into the tour's frames.zip (None if it is not there)."""
+    archive_path = os.path.join(UPLOAD_DIR, tour_id, FRAME_ARCHIVE)
+    if not artifact_store.ensure_local(archive_path):
+        return None
+    with zipfile.ZipFile(archive_path) as zf:
+        try:
+            return zf.read(filename)
+        except KeyError:
+            return None
+
+
+@app.middleware("http")
+async def serve_compacted_frames(request: Request, call_next):
+    """
+    Frame URLs handed out before compaction (/uploads/<tour>/frame-N.jpg)
+    keep working: when the loose file is gone, the frame is served from frames.zip.
+    """
+    response = await call_next(request)
+    path = request.url.path
+    if response.status_code != 404 or request.method not in ("GET", "HEAD") or not path.startswith("/uploads/"):
+        return response
+    parts = path[len("/uploads/"):].split("/")
+    if len(parts) != 2 or not parts[1].endswith(".jpg") or ".." in parts or "" in parts:
+        return response
+
+    data = await asyncio.get_running_loop().run_in_executor(None, read_archived_frame, parts[0], parts[1])
+    if data is None:
+        return response
+    return Response(content=data if request.method == "GET" else b"", media_type="image/jpeg",
+                    headers={"Content-Length": str(len(data))})
+
+# =========================================================
+# 📡 Progress events (Server-Sent Events)
+# =========================================================
+# Long-running operations publish stage events to a named channel:
+#   stitch-<tour_id>             → GET /progress/stitch/<tour_id>
+#   compare-<tourA>-<tourB>      → GET /progress/compare/<tourA>/<tourB>
+#   video-<tour_id>              → GET /progress/video/<tour_id>
+# Clients subscribe before (or while) POSTing; past events of the
+# current run are replayed, so late subscribers and resubmitting
+# clients see the run that is already in progress (a resubmitted job
+# joins that run instead of restarting it). A run that had already
+# finished when the client subscribed is not replayed: the stream
+# waits for the next run instead. Channels are kept
+# in memory on the node doing the work (use sticky sessions when
+# several nodes sit behind a load balancer).
+
+PROGRESS_KEEP_S = int(os.getenv("PROGRESS_KEEP_S", "600"))
+PROGRESS_IDLE_TIMEOUT_S = int(os.getenv("PROGRESS_IDLE_TIMEOUT_S", "300"))
+
+
+class ProgressHub:
+    """Thread-safe, in-memory event log per channel."""
+
+    def __init__(self, keep_s: int):
+        self.keep_s = keep_s
+        self.channels = {}
+        self.runs = 0
+        self.lock = threading.Lock()
+
+    def start(self, channel: str):
+        """
+        Begins a new run on `channel` (previous events are discarded) and
+        returns its id. If a run is still in progress it is left untouched
+        and None is returned: the caller only adds events to it.
+        """
+        now = time.time()
+        with self.lock:
+            # Forget channels that finished long ago
+            for name in [n for n, ch in self.channels.items() if ch["done"] and now - ch["updated"] > self.keep_s]:
+                del self.channels[name]
+            current = self.channels.get(channel)
+            if current is not None and not current["done"] and current["run"] is not None:
+                return None
+            self.runs += 1
+            run = self.runs
+            self.channels[channel] = {"events": [], "done": False, "updated": now, "run": run}
+        self.emit(channel, "started")
+        return run
+
+    def emit(self, channel: str, event: str, **data):
+        if channel is None:
+            return
+        with self.lock:
+            ch = self.channels.setdefault(channel, {"events": [], "done": False, "updated": 0, "run": None})
+            ch["events"].append({"event": event, "data": data, "ts": time.time()})
+            ch["updated"] = time.time()
+
+    def finish(self, channel: str, run, event: str = "done", **data):
+        """Ends run `run`; a no-op for callers that joined someone else's run."""
+        if channel is None or run is None:
+            return
+        with self.lock:
+            ch = self.channels.get(channel)
+            if ch is None or ch["run"] != run:
+                return
+        self.emit(channel, event, **data)
+        with self.lock:
+            ch["done"] = True
+
+    def subscribe(self, channel: str):
+        """
+        Read position for a new subscriber. A run that had already finished
+        when the subscriber connected is skipped: it waits for the next run.
+        """
+        with self.lock:
+            ch = self.channels.get(channel)
+            finished = ch["run"] if ch is not None and ch["done"] else None
+        return {"run": finished, "index": 0, "skip": finished}
+
+    def read(self, channel: str, cursor: dict):
+        """New events for `cursor` (advanced in place), and whether its run has finished."""
+        with self.lock:
+            ch = self.channels.get(channel)
+            if ch is None or (cursor["skip"] is not None and ch["run"] == cursor["skip"]):
+                return [], False
+            if ch["run"] != cursor["run"]:
+                # A new run replaced the one we were following: replay it from the start
+                cursor["run"], cursor["index"] = ch["run"], 0
+            new = ch["events"][cursor["index"]:]
+            cursor["index"] += len(new)
+            return new, ch["done"]
+
+
+progress_hub = ProgressHub(PROGRESS_KEEP_S)
+
+
+def sse_response(channel: str, request: Request):
+    """Streams a progress channel as text/event-stream until the run finishes."""
+
+    async def events():
+        cursor = progress_hub.subscribe(channel)
+        last_event = last_write = time.time()
+        while not await request.is_disconnected():
+            new, done = progress_hub.read(channel, cursor)
+            for offset, ev in enumerate(new, start=cursor["index"] - len(new) + 1):
+                payload = json.dumps({**ev["data"], "ts": ev["ts"]}, default=str)
+                yield f"id: {offset}\nevent: {ev['event']}\ndata: {payload}\n\n"
+                last_event = last_write = time.time()
+            if done:
+                break
+            if time.time() - last_event > PROGRESS_IDLE_TIMEOUT_S:
+                yield "event: timeout\ndata: {}\n\n"
+                break
+            if time.time() - last_write > 15:
+                yield ": keep-alive\n\n"
+                last_write = time.time()
+            await asyncio.sleep(0.25)
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# =========================================================
+# 🎯 Frame selection (blur + redundancy) before stitching
+# =========================================================
+# Captures often contain near-identical and motion-blurred frames.
+# Each frame gets a sharpness score (variance of the Laplacian) and a
+# 64-bit difference hash. Frames much blurrier than the tour median,
+# or almost identical to the last kept frame, are dropped.
+
+FRAME_SELECTION = os.getenv("FRAME_SELECTION", "1") == "1"
+FRAME_BLUR_RATIO = float(os.getenv("FRAME_BLUR_RATIO", "0.35"))   # vs. median sharpness
+FRAME_DUP_HAMMING = int(os.getenv("FRAME_DUP_HAMMING", "4"))      # max dHash bits changed
+FRAME_SCORE_WIDTH = 480
+
+
+def frame_sharpness(gray):
+    """Variance of the Laplacian — low values mean a blurry frame."""
+    return float(cv2.Laplacian(gray, cv2.CV_64F).var())
+
+
+def frame_dhash(gray):
+    """64-bit difference hash of a grayscale frame."""
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int("".join("1" if b else "0" for b in bits), 2)
+
+
+def select_frames(images, filenames):
+    """
+    Returns (kept_indices, report). Always keeps at least two frames;
+    if filtering would leave fewer, every frame is used.
+    """
+    scores, hashes = [], []
+    for img in images:
+        scale = FRAME_SCORE_WIDTH / img.shape[1]
+        small = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA) if scale < 1 else img
+        gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        scores.append(frame_sharpness(gray))
+        hashes.append(frame_dhash(gray))
+
+    blur_threshold = float(np.median(scores)) * FRAME_BLUR_RATIO
+    kept, dropped = [], []
+    for i, filename in enumerate(filenames):
+        if scores[i] < blur_threshold:
+            dropped.append({"filename": filename, "reason": "blurry", "sharpness": round(scores[i], 1)})
+            continue
+        if kept:
+            distance = bin(hashes[i] ^ hashes[kept[-1]]).count("1")
+            if distance <= FRAME_DUP_HAMMING:
+                dropped.append({"filename": filename, "reason": "duplicate",
+                                "duplicate_of": filenames[kept[-1]], "hamming": distance})
+                continue
+        kept.append(i)
+
+    if len(kept) < 2:
+        kept, dropped = list(range(len(images))), []
+
+    report = {
+        "total": len(images),
+        "used": [filenames[i] for i in kept],
+        "dropped": dropped,
+        "blur_threshold": round(blur_threshold, 1),
+    }
+    return kept, report
+
+# =========================================================
+# 🎬 Video keyframe extraction
+# =========================================================
+# Walkthrough videos are decoded frame by frame (cv2.VideoCapture) and
+# never held in memory: only the current frame and the best candidate
+# keyframe are kept. Frames are sampled at VIDEO_SAMPLE_FPS; once the
+# view has changed enough since the last keyframe (dHash distance), the
+# sharpest frame of the next few samples becomes the new keyframe.
+
+VIDEO_SAMPLE_FPS = float(os.getenv("VIDEO_SAMPLE_FPS", "5"))
+VIDEO_MIN_CHANGE = int(os.getenv("VIDEO_MIN_CHANGE", "10"))     # dHash bits vs last keyframe
+VIDEO_MAX_CHANGE = int(os.getenv("VIDEO_MAX_CHANGE", "24"))     # commit early to keep overlap
+VIDEO_KEYFRAME_WINDOW = int(os.getenv("VIDEO_KEYFRAME_WINDOW", "5"))
+VIDEO_MAX_KEYFRAMES = int(os.getenv("VIDEO_MAX_KEYFRAMES", "60"))
+
+
+def extract_keyframes(video_path: str, on_keyframe, on_event=None):
+    """
+    Streams `video_path` and calls `on_keyframe(frame)` for every keyframe picked.
+    Returns decode statistics; `truncated` is True when VIDEO_MAX_KEYFRAMES
+    was reached before the end of the video.
+    """
+    on_event = on_event or (lambda event, **data: None)
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise ValueError("Could not open video (unsupported format or codec)")
+
+    fps = cap.get(cv2.CAP_PROP_FPS) or 30.0
+    step = max(1, int(round(fps / VIDEO_SAMPLE_FPS)))
+    decoded = analyzed = keyframes = 0
+    last_hash = None
+    best = None       # (sharpness, frame, hash) of the best candidate in the window
+    window = 0
+
+    def commit(frame, frame_hash):
+        nonlocal last_hash, keyframes
+        on_keyframe(frame)
+        last_hash = frame_hash
+        keyframes += 1
+
+    try:
+        while keyframes < VIDEO_MAX_KEYFRAMES:
+            # grab() advances without converting skipped frames
+            if not cap.grab():
+                break
+            decoded += 1
+            if (decoded - 1) % step:
+                continue
+            ok, frame = cap.retrieve()
+            if not ok:
+                break
+            analyzed += 1
+            if analyzed % 50 == 0:
+                on_event("video_progress", frames_decoded=decoded, keyframes=keyframes)
+
+            scale = FRAME_SCORE_WIDTH / frame.shape[1]
+            small = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA) if scale < 1 else frame
+            gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+            frame_hash = frame_dhash(gray)
+
+            if last_hash is None:
+                commit(frame, frame_hash)
+                continue
+
+            distance = bin(frame_hash ^ last_hash).count("1")
+            if distance < VIDEO_MIN_CHANGE:
+                continue
+
+            sharpness = frame_sharpness(gray)
+            if best is None or sharpness > best[0]:
+                best = (sharpness, frame, frame_hash)
+            window += 1
+
+            if window >= VIDEO_KEYFRAME_WINDOW or distance >= VIDEO_MAX_CHANGE:
+                commit(best[1], best[2])
+                best, window = None, 0
+
+        if best is not None and keyframes < VIDEO_MAX_KEYFRAMES:
+            commit(best[1], best[2])
+
+        # Hitting the cap only matters if there was video left to look at
+        truncated = keyframes >= VIDEO_MAX_KEYFRAMES and cap.grab()
+        if truncated:
+            logging.warning(f"⚠️ Keyframe limit ({VIDEO_MAX_KEYFRAMES}) reached after {decoded} frames, "
+                            f"rest of the video ignored")
+            on_event("video_truncated", max_keyframes=VIDEO_MAX_KEYFRAMES, frames_decoded=decoded)
+    finally:
+        cap.release()
+
+    return {"fps": fps, "frames_decoded": decoded, "frames_analyzed": analyzed, "keyframes": keyframes,
+            "truncated": bool(truncated)}
+
+# =========================================================
+# 🧵 Stitching strategies (retry ladder + status record)
+# =========================================================
+# cv2.Stitcher is unrolled with cv2.detail (as in OpenCV's
+# stitching_detailed.py) so that features are detected and matched
+# once per tour; each rung of the retry ladder only re-runs camera
+# estimation, bundle adjustment and compositing on those matches:
+#   1. full set, PANORAMA-style (homography, spherical) — always tried,
+#      every pair is matched so a weak consecutive link may not matter
+#   2. if consecutive frames all match: SCANS-style (affine), then a
+#      lower confidence threshold composed at reduced resolution
+#   3. stitch each connected segment separately → partial panoramas
+# Consecutive-pair inliers decide which retries are worth running and
+# where to split segments, and are reported as diagnostics. The outcome
+# is stored next to the panorama (<tour>_panorama.json), so failures
+# are never mistaken for cached successes.
+
+STITCH_MIN_INLIERS = int(os.getenv("STITCH_MIN_INLIERS", "25"))
+STITCH_WORK_MEGAPIX = 0.6      # feature detection / registration (cv2.Stitcher default)
+STITCH_SEAM_MEGAPIX = 0.1      # seam estimation
+STITCH_LOW_RES_MEGAPIX = float(os.getenv("STITCH_LOW_RES_MEGAPIX", "2"))
+PREVIEW_MEGAPIX = 0.1          # per frame, for the preview composed right after registration
+
+STITCH_ERR_COMPOSE = -1
+STITCH_STATUS_NAMES = {
+    cv2.Stitcher_OK: "OK",
+    cv2.Stitcher_ERR_NEED_MORE_IMGS: "ERR_NEED_MORE_IMGS",
+    cv2.Stitcher_ERR_HOMOGRAPHY_EST_FAIL: "ERR_HOMOGRAPHY_EST_FAIL",
+    cv2.Stitcher_ERR_CAMERA_PARAMS_ADJUST_FAIL: "ERR_CAMERA_PARAMS_ADJUST_FAIL",
+    STITCH_ERR_COMPOSE: "ERR_COMPOSE",
+}
+
+# (strategy, model, confidence threshold, compose resolution in Mpx or None for full)
+FULL_SET_LADDER = [
+    ("panorama", "homography", 1.0, None),
+    ("scans", "affine", 1.0, None),
+    ("low_resolution", "homography", 0.6, STITCH_LOW_RES_MEGAPIX),
+]
+SEGMENT_LADDER = [
+    ("panorama", "homography", 1.0, None),
+    ("scans", "affine", 1.0, None),
+]
+
+
+def _megapix_scale(image, megapix):
+    """Scale factor bringing `image` down to `megapix` (never up); None → 1."""
+    if megapix is None:
+        return 1.0
+    return min(1.0, float(np.sqrt(megapix * 1e6 / (image.shape[0] * image.shape[1]))))
+
+
+def _resize(image, scale):
+    if scale >= 1.0:
+        return image
+    return cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+
+class FrameStitcher:
+    """
+    Registration and compositing for one tour's frames. Features are
+    detected once; pairwise matches once per model (homography for
+    PANORAMA, affine for SCANS). `stitch` can then be called for any
+    subset of frames with any estimator settings.
+    """
+
+    def __init__(self, images):
+        self.images = images
+        self.work_scale = _megapix_scale(images[0], STITCH_WORK_MEGAPIX)
+        self.seam_scale = _megapix_scale(images[0], STITCH_SEAM_MEGAPIX)
+        finder = cv2.ORB.create()
+        self.features = [cv2.detail.computeImageFeatures2(finder, _resize(img, self.work_scale)) for img in images]
+        self.seam_images = [_resize(img, self.seam_scale) for img in images]
+        self.matches = {}
+
+    def pairwise(self, model: str):
+        """All-pairs matches for `model`, computed on first use."""
+        if model not in self.matches:
+            if model == "affine":
+                matcher = cv2.detail.AffineBestOf2NearestMatcher(False, False, 0.3)
+            else:
+                matcher = cv2.detail.BestOf2NearestMatcher(False, 0.3)
+            self.matches[model] = matcher.apply2(self.features)
+            matcher.collectGarbage()
+        return self.matches[model]
+
+    def consecutive_inliers(self):
+        """RANSAC inlier counts between each pair of consecutive frames."""
+        pairwise, n = self.pairwise("homography"), len(self.images)
+        return [int(pairwise[i * n + i + 1].num_inliers) for i in range(n - 1)]
+
+    def _subset(self, indices, model: str):
+        """Features and matches of `indices`, renumbered 0..len-1 as cv2.detail expects."""
+        pairwise, n = self.pairwise(model), len(self.images)
+        features, matches = [], []
+        for a, i in enumerate(indices):
+            self.features[i].img_idx = a
+            features.append(self.features[i])
+            for b, j in enumerate(indices):
+                info = pairwise[i * n + j]
+                if info.src_img_idx >= 0:
+                    info.src_img_idx, info.dst_img_idx = a, b
+                matches.append(info)
+        return features, matches
+
+    def stitch(self, indices, model: str, confidence: float, compose_megapix=None, on_registered=None):
+        """
+        Registers and composes frames `indices`. Like cv2.Stitcher, frames
+        outside the biggest connected component are left out.
+        `on_registered(used indices, composition)` runs before the full-size
+        compose, e.g. to blend a quick preview.
+        Returns (status, used indices, cameras, panorama or None).
+        """
+        features, matches = self._subset(indices, model)
+        component = [int(k) for k in np.ravel(cv2.detail.leaveBiggestComponent(features, matches, confidence))]
+        if len(component) < 2:
+            return cv2.Stitcher_ERR_NEED_MORE_IMGS, [], None, None
+        if len(component) < len(indices):
+            indices = [indices[k] for k in component]
+            features, matches = self._subset(indices, model)
+
+        if model == "affine":
+            estimator, adjuster = cv2.detail.AffineBasedEstimator(), cv2.detail.BundleAdjusterAffinePartial()
+        else:
+            estimator, adjuster = cv2.detail.HomographyBasedEstimator(), cv2.detail.BundleAdjusterRay()
+        ok, cameras = estimator.apply(features, matches, None)
+        if not ok:
+            return cv2.Stitcher_ERR_HOMOGRAPHY_EST_FAIL, indices, None, None
+        for cam in cameras:
+            cam.R = cam.R.astype(np.float32)
+        adjuster.setConfThresh(confidence)
+        adjuster.setRefinementMask(np.ones((3, 3), np.uint8))
+        ok, cameras = adjuster.apply(features, matches, cameras)
+        if not ok:
+            return cv2.Stitcher_ERR_CAMERA_PARAMS_ADJUST_FAIL, indices, None, None
+        if model == "homography":
+            rmats = cv2.detail.waveCorrect([np.copy(cam.R) for cam in cameras], cv2.detail.WAVE_CORRECT_HORIZ)
+            for cam, R in zip(cameras, rmats):
+                cam.R = R
+
+        try:
+            composition = self.prepare(indices, cameras, model)
+            if on_registered is not None:
+                on_registered(indices, composition)
+            pano = self.blend(composition, compose_megapix)
+        except cv2.error as e:
+            logging.warning(f"⚠️ Compositing {len(indices)} frames failed: {e}")
+            return STITCH_ERR_COMPOSE, indices, cameras, None
+        return cv2.Stitcher_OK, indices, cameras, pano
+
+    @staticmethod
+    def _scaled_K(cam, aspect):
+        K = cam.K().astype(np.float32)
+        K[0, 0] *= aspect
+        K[0, 2] *= aspect
+        K[1, 1] *= aspect
+        K[1, 2] *= aspect
+        return K
+
+    def prepare(self, indices, cameras, model: str):
+        """Estimates seams and exposure gains of registered frames (on small copies)."""
+        focals = sorted(cam.focal for cam in cameras)
+        mid = len(focals) // 2
+        warped_scale = focals[mid] if len(focals) % 2 else (focals[mid - 1] + focals[mid]) / 2
+        warp_type = "affine" if model == "affine" else "spherical"
+
+        seam_aspect = self.seam_scale / self.work_scale
+        warper = cv2.PyRotationWarper(warp_type, warped_scale * seam_aspect)
+        corners, warped_images, warped_masks = [], [], []
+        for cam, i in zip(cameras, indices):
+            K = self._scaled_K(cam, seam_aspect)
+            img = self.seam_images[i]
+            corner, warped = warper.warp(img, K, cam.R, cv2.INTER_LINEAR, cv2.BORDER_REFLECT)
+            _, mask = warper.warp(np.full(img.shape[:2], 255, np.uint8), K, cam.R,
+                                  cv2.INTER_NEAREST, cv2.BORDER_CONSTANT)
+            corners.append(corner)
+            warped_images.append(warped)
+            warped_masks.append(mask)
+
+        compensator = cv2.detail.ExposureCompensator_createDefault(
+            cv2.detail.ExposureCompensator_NO if model == "affine" else cv2.detail.ExposureCompensator_GAIN_BLOCKS)
+        compensator.feed(corners=corners, images=warped_images, masks=warped_masks)
+        seam_finder = cv2.detail.GraphCutSeamFinder("COST_COLOR")
+        seam_masks = seam_finder.find([img.astype(np.float32) for img in warped_images], corners, warped_masks)
+        return {"indices": indices, "cameras": cameras, "warp_type": warp_type, "warped_scale": warped_scale,
+                "compensator": compensator, "seam_masks": seam_masks}
+
+    def blend(self, composition: dict, megapix=None):
+        """Warps and blends prepared frames at `megapix` per frame (None = full size)."""
+        indices, cameras = composition["indices"], composition["cameras"]
+        warp_type, warped_scale = composition["warp_type"], composition["warped_scale"]
+        compensator, seam_masks = composition["compensator"], composition["seam_masks"]
+        scaled_K = self._scaled_K
+
+        compose_scale = _megapix_scale(self.images[indices[0]], megapix)
+        aspect = compose_scale / self.work_scale
+        warper = cv2.PyRotationWarper(warp_type, warped_scale * aspect)
+        rois = []
+        for cam, i in zip(cameras, indices):
+            h, w = self.images[i].shape[:2]
+            rois.append(warper.warpRoi((int(round(w * compose_scale)), int(round(h * compose_scale))),
+                                       scaled_K(cam, aspect), cam.R))
+        result_roi = cv2.detail.resultRoi(corners=[r[0:2] for r in rois], sizes=[r[2:4] for r in rois])
+        blend_width = np.sqrt(result_roi[2] * result_roi[3]) * 5 / 100
+        if blend_width < 1:
+            blender = cv2.detail.Blender_createDefault(cv2.detail.Blender_NO)
+        else:
+            blender = cv2.detail.MultiBandBlender()
+            blender.setNumBands(int(np.log(blend_width) / np.log(2.0) - 1.0))
+        blender.prepare(result_roi)
+
+        for k, (cam, i) in enumerate(zip(cameras, indices)):
+            K = scaled_K(cam, aspect)
+            img = _resize(self.images[i], compose_scale)
+            corner, warped = warper.warp(img, K, cam.R, cv2.INTER_LINEAR, cv2.BORDER_REFLECT)
+            _, mask = warper.warp(np.full(img.shape[:2], 255, np.uint8), K, cam.R,
+                                  cv2.INTER_NEAREST, cv2.BORDER_CONSTANT)
+            warped = compensator.apply(k, corner, warped, mask)
+            seam_mask = cv2.resize(cv2.dilate(seam_masks[k], None), (mask.shape[1], mask.shape[0]),
+                                   0, 0, cv2.INTER_LINEAR_EXACT)
+            mask = cv2.bitwise_and(seam_mask, cv2.UMat(mask))
+            blender.feed(cv2.UMat(warped.astype(np.int16)), mask, corner)
+
+        result, _ = blender.blend(None, None)
+        return np.clip(result, 0, 255).astype(np.uint8)
+
+
+def split_segments(inliers):
+    """Splits frame indices 0..count-1 wherever consecutive frames barely match."""
+    segments, current = [], [0]
+    for i, n in enumerate(inliers):
+        if n < STITCH_MIN_INLIERS:
+            segments.append(current)
+            current = []
+        current.append(i + 1)
+    segments.append(current)
+    return segments
+
+
+def split_at_weakest(segment, inliers):
+    """Halves a segment at its weakest consecutive match."""
+    links = [(inliers[i], pos) for pos, i in enumerate(segment[:-1])]
+    _, pos = min(links)
+    return [segment[:pos + 1], segment[pos + 1:]]
+
+
+def stitch_with_fallbacks(images, filenames, on_event=None, on_preview=None):
+    """
+    Runs the retry ladder. Returns (outcome, panoramas, diagnostics) where
+    outcome is "ok", "partial" or "failed" and panoramas is a list of
+    (frame indices, image), largest first.
+    `on_event(event, **data)` is called as features are matched and after each attempt;
+    `on_preview(image, **data)` once, with a low-resolution blend of the
+    first registration that succeeds (before its full-size compose).
+    """
+    attempts = []
+    on_event = on_event or (lambda event, **data: None)
+    previewed = []
+
+    start_time = time.time()
+    stitcher = FrameStitcher(images)
+    inliers = stitcher.consecutive_inliers()
+    segments = split_segments(inliers)
+    diagnostics = {
+        "attempts": attempts,
+        "matching_seconds": round(time.time() - start_time, 2),
+        "pair_inliers": [
+            {"a": filenames[i], "b": filenames[i + 1], "inliers": n} for i, n in enumerate(inliers)
+        ],
+        "weak_links": [
+            {"a": filenames[i], "b": filenames[i + 1], "inliers": n}
+            for i, n in enumerate(inliers) if n < STITCH_MIN_INLIERS
+        ],
+    }
+    on_event("features_matched", segments=len(segments), weak_links=diagnostics["weak_links"])
+
+    def preview(strategy, used, composition):
+        if on_preview is None or previewed:
+            return
+        previewed.append(strategy)
+        try:
+            on_preview(stitcher.blend(composition, PREVIEW_MEGAPIX), strategy=strategy,
+                       frames=[filenames[i] for i in used])
+        except Exception as e:
+            # A preview is a nicety: never let it fail the stitch
+            logging.warning(f"⚠️ Could not produce stitch preview: {e}")
+
+    def attempt(strategy, indices, model, confidence, compose_megapix):
+        start_time = time.time()
+        status, used, _, pano = stitcher.stitch(
+            indices, model, confidence, compose_megapix,
+            on_registered=lambda used, composition: preview(strategy, used, composition),
         )
-    except Exception:
-        files = sorted([
-            os.path.join(tour_dir, f)
-            for f in os.listdir(tour_dir)
-            if f.endswith(".jpg")
-        ])
-    return files
+        attempts.append({
+            "strategy": strategy,
+            "frames": [filenames[indices[0]], filenames[indices[-1]]],
+            "frame_count": len(indices),
+            "frames_left_out": [filenames[i] for i in indices if i not in used],
+            "status": int(status),
+            "status_name": STITCH_STATUS_NAMES.get(status, str(status)),
+            "seconds": round(time.time() - start_time, 2),
+        })
+        logging.info(f"🧵 Stitch attempt {strategy} on {len(indices)} frames → "
+                     f"{STITCH_STATUS_NAMES.get(status, status)}")
+        on_event("stitch_attempt", **attempts[-1])
+        return (used, pano) if pano is not None else None
+
+    # 1️⃣ Full set — the default PANORAMA attempt always runs; the other
+    # retries only when every frame connects to the next
+    everything = list(range(len(images)))
+    ladder = FULL_SET_LADDER if len(segments) == 1 else FULL_SET_LADDER[:1]
+    for strategy, model, confidence, megapix in ladder:
+        result = attempt(strategy, everything, model, confidence, megapix)
+        if result is not None:
+            return "ok", [result], diagnostics
+
+    if len(segments) == 1:
+        segments = split_at_weakest(everything, inliers) if len(images) > 2 else []
+    else:
+        logging.warning(f"⚠️ Frames form {len(segments)} disconnected segments, stitching them separately")
+
+    # 2️⃣ Segment stitching → partial panoramas
+    panoramas = []
+    for segment in sorted(segments, key=len, reverse=True):
+        if len(segment) < 2:
+            continue
+        for strategy, model, confidence, megapix in SEGMENT_LADDER:
+            result = attempt(f"segment_{strategy}", segment, model, confidence, megapix)
+            if result is not None:
+                panoramas.append(result)
+                break
+
+    diagnostics["segments"] = [[filenames[i] for i in seg] for seg in segments]
+    return ("partial" if panoramas else "failed"), panoramas, diagnostics
+
+
+def stitch_status_path(tour_id: str):
+    return os.path.join(STITCHED_DIR, f"{tour_id}_panorama.json")
+
+
+def read_stitch_status(tour_id: str):
+    """Recorded outcome of the last stitch (None for legacy panoramas)."""
+    path = stitch_status_path(tour_id)
+    if not artifact_store.ensure_local(path):
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_stitch_status(tour_id: str, status: dict):
+    path = stitch_status_path(tour_id)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(status, f, indent=2)
+    os.replace(tmp_path, path)
+    artifact_store.publish(path)
+
+
+def frames_signature(tour_id: str):
+    """Changes whenever a frame is added, removed or replaced."""
+    with manifest_lock(tour_id):
+        frames = read_tour_manifest(tour_id)["frames"]
+    return hashlib.sha1(json.dumps([(fr["filename"], fr["size"]) for fr in frames]).encode()).hexdigest()
 
 # =========================================================
 # Load Models
@@ -132,6 +1680,9 @@ print("✅ SegFormer model loaded successfully.")
 # Prevent CPU overload on Laptop
 torch.set_num_threads(2)
 
+# Models are shared by all request threads; run inference one job at a time
+inference_lock = threading.Lock()
+
 device = torch.device("cpu")
 seg_model.to(device)
 
@@ -141,89 +1692,102 @@ custom_yolo_model = YOLO(os.path.join(MODEL_DIR, "best.pt"))
 print("✅ Custom YOLOv8 model loaded successfully.")
 
 # =========================================================
-# 🔹 YOLOv8 Instance Segmentation (Highlight Chairs & Persons)
+# 🎨 Shared colour tables
 # =========================================================
-def run_yolo_seg(input_path: str, output_path: str):
+
+# ✅ Fixed bright construction colors (RGB)
+CUSTOM_COLORS = {
+    'wall': [255, 0, 0],        # red
+    'floor': [0, 255, 0],       # green
+    'ceiling': [255, 255, 0],   # yellow
+    'windowpane': [0, 255, 255],# cyan
+    'door': [255, 165, 0],      # orange
+    'table': [128, 0, 128],     # purple
+    'cabinet': [0, 0, 255],     # blue
+    'desk': [255, 105, 180],    # pink
+}
+
+# ADE20K labels list (to map names → indices)
+ADE20K_CLASSES = [
+    'wall', 'building', 'sky', 'floor', 'tree', 'ceiling', 'road', 'bed', 'windowpane',
+    'grass', 'cabinet', 'sidewalk', 'person', 'earth', 'door', 'table', 'mountain',
+    'plant', 'curtain', 'chair', 'car', 'water', 'painting', 'sofa', 'shelf', 'house',
+    'sea', 'mirror', 'rug', 'field', 'armchair', 'seat', 'fence', 'desk', 'rock',
+    'wardrobe', 'lamp', 'bathtub', 'railing', 'cushion', 'base', 'box', 'column',
+    'signboard', 'chest of drawers', 'counter', 'sand', 'sink', 'skyscraper', 'fireplace',
+    'refrigerator', 'grandstand', 'path', 'stairs', 'runway', 'case', 'pool table',
+    'pillow', 'screen door', 'stairway', 'river', 'bridge', 'bookcase', 'blind',
+    'coffee table', 'toilet', 'flower', 'book', 'hill', 'bench', 'countertop', 'stove',
+    'palm', 'kitchen island', 'computer', 'swivel chair', 'boat', 'bar', 'arcade machine',
+    'hovel', 'bus', 'towel', 'light', 'truck', 'tower', 'chandelier', 'awning',
+    'streetlight', 'booth', 'television', 'airplane', 'dirt track', 'apparel', 'pole',
+    'land', 'bannister', 'escalator', 'ottoman', 'bottle', 'buffet', 'poster', 'stage',
+    'van', 'ship', 'fountain', 'conveyer belt', 'canopy', 'washer', 'plaything',
+    'swimming pool', 'stool', 'barrel', 'basket', 'waterfall', 'tent', 'bag', 'minibike',
+    'cradle', 'oven', 'ball', 'food', 'step', 'tank', 'trade name', 'microwave', 'pot',
+    'animal', 'bicycle', 'lake', 'dishwasher', 'screen', 'blanket', 'sculpture', 'hood',
+    'sconce', 'vase', 'traffic light', 'tray', 'ashcan', 'fan', 'pier', 'crt screen',
+    'plate', 'monitor', 'bulletin board', 'shower', 'radiator', 'glass', 'clock', 'flag'
+]
+
+
+def yolo_highlight_color(class_name: str):
     """
-    Runs YOLOv8 instance segmentation on an image and highlights key objects.
     - 'chair' → pink overlay
     - 'person' → orange overlay
     Other objects → green overlay (default)
     """
+    if class_name == "chair":
+        return (255, 105, 180)  # pink
+    elif class_name == "person":
+        return (255, 165, 0)    # orange
+    return (0, 255, 0)          # green (default)
 
-    # Run YOLOv8-Seg model on input image
-    results = yolo_model(input_path)
-    result = results[0]
-
-    # Load image
-    img = cv2.imread(input_path)
-    if img is None:
-        print(f"❌ Could not load image from {input_path}")
-        return
-
-    # If YOLO detected masks, process them
-    if result.masks is not None:
-        masks = result.masks.data.cpu().numpy()
-        boxes = result.boxes
-        names = yolo_model.names
-
-        for i, mask in enumerate(masks):
-            class_id = int(boxes.cls[i])
-            class_name = names[class_id]
-
-            # --- 🎨 Custom highlight colors ---
-            if class_name == "chair":
-                color = (255, 105, 180)  # pink
-            elif class_name == "person":
-                color = (255, 165, 0)    # orange
-            else:
-                color = (0, 255, 0)      # green (default)
 
-            # Resize mask to match image size
-            mask_resized = cv2.resize(mask, (img.shape[1], img.shape[0]), interpolation=cv2.INTER_NEAREST)
-            mask_binary = mask_resized.astype(bool)
+def segformer_color_mask(seg_map):
+    """Builds an RGB color mask for a SegFormer class map."""
+    color_mask = np.zeros((*seg_map.shape, 3), dtype=np.uint8)
 
-            # Blend the color into the image (0.4 background, 0.6 color)
-            img[mask_binary] = img[mask_binary] * 0.4 + np.array(color) * 0.6
-
-        # --- 📦 Draw bounding boxes for detected objects ---
-        for box in boxes:
-            x1, y1, x2, y2 = map(int, box.xyxy[0])
-            cls_name = names[int(box.cls[0])]
-            conf = float(box.conf[0])
-
-            # Reuse the same color used above (default green if not chair/person)
-            if cls_name == "chair":
-                color = (255, 105, 180)
-            elif cls_name == "person":
-                color = (255, 165, 0)
-            else:
-                color = (0, 255, 0)
-
-            # Draw bounding box
-            cv2.rectangle(img, (x1, y1), (x2, y2), color, 2)
+    # Fixed seed so random colors stay consistent
+    random.seed(42)
 
-            # Add class label + confidence
-            cv2.putText(img, f"{cls_name} {conf:.2f}", (x1, max(y1 - 5, 20)),
-                        cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 2)
+    for class_id, class_name in enumerate(ADE20K_CLASSES):
+        mask = seg_map == class_id
+        color = CUSTOM_COLORS.get(class_name, [random.randint(0, 255) for _ in range(3)])
+        color_mask[mask] = color
+    return color_mask
 
-    # Save final result
-    cv2.imwrite(output_path, img)
-    print(f"✅ YOLO-Seg output saved: {output_path}")
 
 # =========================================================
-# 🔹 semantic segmentation & saves a colored overlay result
+# 🔹 Model inference (shared by all overlays)
 # =========================================================
+def predict_yolo_seg(image):
+    """
+    Runs YOLOv8-Seg on a decoded BGR image.
+    Returns plain arrays: boxes (xyxy), classes, confidences and, when the
+    model produced them, binary masks at the model's mask resolution.
+    """
+    result = yolo_model(image, verbose=False)[0]
+    prediction = {
+        "xyxy": result.boxes.xyxy.cpu().numpy().astype(np.float32),
+        "cls": result.boxes.cls.cpu().numpy().astype(np.int32),
+        "conf": result.boxes.conf.cpu().numpy().astype(np.float32),
+    }
+    if result.masks is not None:
+        prediction["masks"] = result.masks.data.cpu().numpy().astype(np.uint8)
+    return prediction
 
-def run_segmentation(input_path, output_path):
-    """Runs semantic segmentation & saves a colored overlay result (SegFormer version)."""
-    image = cv2.imread(input_path)
+
+def predict_segformer(image):
+    """
+    Runs SegFormer on a decoded BGR image.
+    Returns the class map (H x W, uint8) at the original resolution.
+    """
     rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
 
     # ✅ Convert to PIL for SegFormer processor
     pil_image = Image.fromarray(rgb_image)
 
-    # Run through SegFormer
     inputs = processor(images=pil_image, return_tensors="pt")
     with torch.no_grad():
         outputs = seg_model(**inputs)
@@ -235,202 +1799,168 @@ def run_segmentation(input_path, output_path):
         mode="bilinear",
         align_corners=False,
     )
-
     seg_map = logits.argmax(dim=1)[0].cpu().numpy()
 
     # Resize to exact original shape (safety)
-    seg_map_resized = cv2.resize(seg_map.astype(np.uint8),
-                                 (rgb_image.shape[1], rgb_image.shape[0]),
-                                 interpolation=cv2.INTER_NEAREST)
-
-    # ✅ Your fixed bright construction colors
-    CUSTOM_COLORS = {
-        'wall': [255, 0, 0],        # red
-        'floor': [0, 255, 0],       # green
-        'ceiling': [255, 255, 0],   # yellow
-        'windowpane': [0, 255, 255],# cyan
-        'door': [255, 165, 0],      # orange
-        'table': [128, 0, 128],     # purple
-        'cabinet': [0, 0, 255],     # blue
-        'desk': [255, 105, 180],    # pink
-    }
+    return cv2.resize(seg_map.astype(np.uint8),
+                      (rgb_image.shape[1], rgb_image.shape[0]),
+                      interpolation=cv2.INTER_NEAREST)
 
-    # ADE20K labels list (to map names → indices)
-    ADE20K_CLASSES = [
-        'wall', 'building', 'sky', 'floor', 'tree', 'ceiling', 'road', 'bed', 'windowpane',
-        'grass', 'cabinet', 'sidewalk', 'person', 'earth', 'door', 'table', 'mountain',
-        'plant', 'curtain', 'chair', 'car', 'water', 'painting', 'sofa', 'shelf', 'house',
-        'sea', 'mirror', 'rug', 'field', 'armchair', 'seat', 'fence', 'desk', 'rock',
-        'wardrobe', 'lamp', 'bathtub', 'railing', 'cushion', 'base', 'box', 'column',
-        'signboard', 'chest of drawers', 'counter', 'sand', 'sink', 'skyscraper', 'fireplace',
-        'refrigerator', 'grandstand', 'path', 'stairs', 'runway', 'case', 'pool table',
-        'pillow', 'screen door', 'stairway', 'river', 'bridge', 'bookcase', 'blind',
-        'coffee table', 'toilet', 'flower', 'book', 'hill', 'bench', 'countertop', 'stove',
-        'palm', 'kitchen island', 'computer', 'swivel chair', 'boat', 'bar', 'arcade machine',
-        'hovel', 'bus', 'towel', 'light', 'truck', 'tower', 'chandelier', 'awning',
-        'streetlight', 'booth', 'television', 'airplane', 'dirt track', 'apparel', 'pole',
-        'land', 'bannister', 'escalator', 'ottoman', 'bottle', 'buffet', 'poster', 'stage',
-        'van', 'ship', 'fountain', 'conveyer belt', 'canopy', 'washer', 'plaything',
-        'swimming pool', 'stool', 'barrel', 'basket', 'waterfall', 'tent', 'bag', 'minibike',
-        'cradle', 'oven', 'ball', 'food', 'step', 'tank', 'trade name', 'microwave', 'pot',
-        'animal', 'bicycle', 'lake', 'dishwasher', 'screen', 'blanket', 'sculpture', 'hood',
-        'sconce', 'vase', 'traffic light', 'tray', 'ashcan', 'fan', 'pier', 'crt screen',
-        'plate', 'monitor', 'bulletin board', 'shower', 'radiator', 'glass', 'clock', 'flag'
-    ]
 
-    # Create color mask (same shape as image)
-    color_mask = np.zeros_like(rgb_image)
+# Predictions are kept next to the decoded panoramas (panorama_cache/),
+# so an overlay requested later reuses them instead of running the model
+# again. They are ignored once the panorama is newer (re-stitched).
+#   <tour>_segformer.npy   class map (H x W, uint8)
+#   <tour>_yolo.npz        boxes / classes / confidences / masks
 
-    # Fixed seed so random colors stay consistent
-    random.seed(42)
+def prediction_cache_path(tour_id: str, model: str):
+    ext = "npy" if model == "segformer" else "npz"
+    return os.path.join(PANORAMA_CACHE_DIR, f"{tour_id}_{model}.{ext}")
 
-    # Assign colors
-    for class_id, class_name in enumerate(ADE20K_CLASSES):
-        mask = seg_map_resized == class_id
-        color = CUSTOM_COLORS.get(class_name, [random.randint(0, 255) for _ in range(3)])
-        color_mask[mask] = color
 
-    # Overlay
-    final = cv2.addWeighted(rgb_image, 0.6, color_mask, 0.6, 0)
-    cv2.imwrite(output_path, cv2.cvtColor(final, cv2.COLOR_RGB2BGR))
-    
+def load_prediction(tour_id: str, model: str):
+    """Cached `model` ("segformer" or "yolo") prediction for the tour's current panorama, or None."""
+    path = prediction_cache_path(tour_id, model)
+    jpg_path = panorama_path(tour_id)
+    if not os.path.exists(path) or not os.path.exists(jpg_path) or os.path.getmtime(path) < os.path.getmtime(jpg_path):
+        return None
+    storage_manager.touch(path)
+    try:
+        if model == "segformer":
+            return np.asarray(np.load(path, mmap_mode="c"))
+        with np.load(path) as data:
+            return {key: data[key] for key in data.files}
+    except (OSError, ValueError) as e:
+        logging.warning(f"⚠️ Cached {model} prediction unreadable for {tour_id} ({e}), predicting again.")
+        return None
+
+
+def cache_prediction(tour_id: str, model: str, prediction):
+    path = prediction_cache_path(tour_id, model)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        if model == "segformer":
+            np.save(f, prediction)
+        else:
+            np.savez_compressed(f, **prediction)
+    os.replace(tmp_path, path)
+
 
 # =========================================================
-# 🔹 Combined YOLO-Seg + SegFormer Semantic Overlay
+# 🔹 YOLOv8 Instance Segmentation (Highlight Chairs & Persons)
 # =========================================================
-def run_combined_segformer_yoloseg(input_path: str, output_path: str):
-    """
-    Combines SegFormer (semantic segmentation) + YOLOv8-Seg (instance segmentation)
-    into one intelligent visual output.
-    """
+def render_yolo_seg(image, prediction, output_path: str):
+    """Draws a YOLOv8-Seg prediction onto a copy of `image` and saves it."""
+    img = image.copy()
 
-    image = cv2.imread(input_path)
-    if image is None:
-        print(f"❌ Error: Could not load image from {input_path}")
-        return
+    # If YOLO detected masks, process them
+    masks = prediction.get("masks")
+    if masks is not None:
+        names = yolo_model.names
 
-    rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-    pil_image = Image.fromarray(rgb_image)
-    H, W, _ = rgb_image.shape
+        for i, mask in enumerate(masks):
+            color = yolo_highlight_color(names[int(prediction["cls"][i])])
 
-    # =====================================================
-    # 1️⃣ Run SegFormer (structure segmentation)
-    # =====================================================
-    inputs = processor(images=pil_image, return_tensors="pt")
-    with torch.no_grad():
-        outputs = seg_model(**inputs)
+            # Resize mask to match image size
+            mask_resized = cv2.resize(mask, (img.shape[1], img.shape[0]), interpolation=cv2.INTER_NEAREST)
+            mask_binary = mask_resized.astype(bool)
 
-    logits = torch.nn.functional.interpolate(
-        outputs.logits, size=pil_image.size[::-1], mode="bilinear", align_corners=False
-    )
-    seg_map = logits.argmax(dim=1)[0].cpu().numpy()
+            # Blend the color into the image (0.4 background, 0.6 color)
+            img[mask_binary] = img[mask_binary] * 0.4 + np.array(color) * 0.6
 
-    CUSTOM_COLORS = {
-        'wall': [255, 0, 0],
-        'floor': [0, 255, 0],
-        'ceiling': [255, 255, 0],
-        'windowpane': [0, 255, 255],
-        'door': [255, 165, 0],
-        'table': [128, 0, 128],
-        'cabinet': [0, 0, 255],
-        'desk': [255, 105, 180],
-    }
+        # --- 📦 Draw bounding boxes for detected objects ---
+        for xyxy, cls_id, conf in zip(prediction["xyxy"], prediction["cls"], prediction["conf"]):
+            x1, y1, x2, y2 = map(int, xyxy)
+            cls_name = names[int(cls_id)]
+            conf = float(conf)
+            color = yolo_highlight_color(cls_name)
 
-    color_mask = np.zeros_like(rgb_image)
-    random.seed(42)
+            # Draw bounding box
+            cv2.rectangle(img, (x1, y1), (x2, y2), color, 2)
 
-    ADE20K_CLASSES = [
-        'wall', 'building', 'sky', 'floor', 'tree', 'ceiling', 'road', 'bed', 'windowpane',
-        'grass', 'cabinet', 'sidewalk', 'person', 'earth', 'door', 'table', 'mountain',
-        'plant', 'curtain', 'chair', 'car', 'water', 'painting', 'sofa', 'shelf', 'house',
-        'sea', 'mirror', 'rug', 'field', 'armchair', 'seat', 'fence', 'desk', 'rock',
-        'wardrobe', 'lamp', 'bathtub', 'railing', 'cushion', 'base', 'box', 'column',
-        'signboard', 'chest of drawers', 'counter', 'sand', 'sink', 'skyscraper', 'fireplace',
-        'refrigerator', 'grandstand', 'path', 'stairs', 'runway', 'case', 'pool table',
-        'pillow', 'screen door', 'stairway', 'river', 'bridge', 'bookcase', 'blind',
-        'coffee table', 'toilet', 'flower', 'book', 'hill', 'bench', 'countertop', 'stove',
-        'palm', 'kitchen island', 'computer', 'swivel chair', 'boat', 'bar', 'arcade machine',
-        'hovel', 'bus', 'towel', 'light', 'truck', 'tower', 'chandelier', 'awning',
-        'streetlight', 'booth', 'television', 'airplane', 'dirt track', 'apparel', 'pole',
-        'land', 'bannister', 'escalator', 'ottoman', 'bottle', 'buffet', 'poster', 'stage',
-        'van', 'ship', 'fountain', 'conveyer belt', 'canopy', 'washer', 'plaything',
-        'swimming pool', 'stool', 'barrel', 'basket', 'waterfall', 'tent', 'bag', 'minibike',
-        'cradle', 'oven', 'ball', 'food', 'step', 'tank', 'trade name', 'microwave', 'pot',
-        'animal', 'bicycle', 'lake', 'dishwasher', 'screen', 'blanket', 'sculpture', 'hood',
-        'sconce', 'vase', 'traffic light', 'tray', 'ashcan', 'fan', 'pier', 'crt screen',
-        'plate', 'monitor', 'bulletin board', 'shower', 'radiator', 'glass', 'clock', 'flag'
-    ]
+            # Add class label + confidence
+            cv2.putText(img, f"{cls_name} {conf:.2f}", (x1, max(y1 - 5, 20)),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 2)
 
-    for class_id, class_name in enumerate(ADE20K_CLASSES):
-        mask = seg_map == class_id
-        color = CUSTOM_COLORS.get(class_name, [random.randint(0, 255) for _ in range(3)])
-        color_mask[mask] = color
+    # Save final result (encoded in the background)
+    image_writer.submit(output_path, img)
+    print(f"✅ YOLO-Seg output queued: {output_path}")
+
+
+# =========================================================
+# 🔹 semantic segmentation & saves a colored overlay result
+# =========================================================
+def render_segmentation(image, seg_map, output_path: str):
+    """Blends a SegFormer class map over `image` and saves it."""
+    rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    final = cv2.addWeighted(rgb_image, 0.6, segformer_color_mask(seg_map), 0.6, 0)
+    image_writer.submit(output_path, cv2.cvtColor(final, cv2.COLOR_RGB2BGR))
 
-    segformer_overlay = cv2.addWeighted(rgb_image, 0.5, color_mask, 0.5, 0)
+
+# =========================================================
+# 🔹 Combined YOLO-Seg + SegFormer Semantic Overlay
+# =========================================================
+def render_combined(image, seg_map, prediction, output_path: str):
+    """Draws SegFormer structure + YOLOv8-Seg objects into one overlay and saves it."""
+    rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    H, W, _ = rgb_image.shape
 
     # =====================================================
-    # 2️⃣ Run YOLOv8-Seg (object segmentation)
+    # 1️⃣ SegFormer (structure segmentation)
     # =====================================================
-    results = yolo_model(rgb_image, verbose=False)
-    combined = segformer_overlay.copy()
+    combined = cv2.addWeighted(rgb_image, 0.5, segformer_color_mask(seg_map), 0.5, 0)
 
-    for result in results:
-        if result.masks is None:
-             continue
-
-        boxes = result.boxes
-        masks = result.masks.data.cpu().numpy()
+    # =====================================================
+    # 2️⃣ YOLOv8-Seg (object segmentation)
+    # =====================================================
+    masks = prediction.get("masks")
+    if masks is not None:
         names = yolo_model.names
 
         for i, mask in enumerate(masks):
-            class_id = int(boxes.cls[i])
-            class_name = names[class_id]
-
-            # --- 🎨 Custom highlight colors ---
-            if class_name == "chair":
-                 color = (255, 105, 180)  # pink
-            elif class_name == "person":
-                 color = (255, 165, 0)    # orange
-            else:
-                 color = (0, 255, 0)      # green (default)
+            class_name = names[int(prediction["cls"][i])]
+            color = yolo_highlight_color(class_name)
 
-        # --- 🩵 Apply segmentation mask ---
+            # --- 🩵 Apply segmentation mask ---
             mask_resized = cv2.resize(mask, (W, H), interpolation=cv2.INTER_NEAREST)
             mask_binary = mask_resized.astype(bool)
             combined[mask_binary] = combined[mask_binary] * 0.5 + np.array(color) * 0.5
 
-        # --- 🟩 Draw bounding box + label ---
-            x1, y1, x2, y2 = map(int, boxes.xyxy[i])
-            conf = float(boxes.conf[i])
+            # --- 🟩 Draw bounding box + label ---
+            x1, y1, x2, y2 = map(int, prediction["xyxy"][i])
+            conf = float(prediction["conf"][i])
             label_text = f"{class_name} {conf:.2f}"
 
-        # Draw bounding box with same color
+            # Draw bounding box with same color
             cv2.rectangle(combined, (x1, y1), (x2, y2), color, 2)
 
-        # Draw label background (black rectangle behind text)
+            # Draw label background (black rectangle behind text)
             (tw, th), _ = cv2.getTextSize(label_text, cv2.FONT_HERSHEY_SIMPLEX, 0.6, 2)
             cv2.rectangle(combined, (x1, y1 - th - 6), (x1 + tw + 2, y1), (0, 0, 0), -1)
 
-        # Put white label text
+            # Put white label text
             cv2.putText(combined, label_text, (x1, y1 - 5),
-                         cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 2)
-
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 2)
 
     # Save
-    cv2.imwrite(output_path, cv2.cvtColor(combined, cv2.COLOR_RGB2BGR))
-    print(f"✅ Combined YOLO+SegFormer output saved: {output_path}")
+    image_writer.submit(output_path, cv2.cvtColor(combined, cv2.COLOR_RGB2BGR))
+    print(f"✅ Combined YOLO+SegFormer output queued: {output_path}")
+
 
 # =========================================================
 # 🔹Own yolomodel
 # =========================================================
-def run_custom_yolo_change_detection(model, before_path, after_path, output_dir, tourA, tourB):
+def run_custom_yolo_change_detection(model, before_path, after_path, output_dir, tourA, tourB,
+                                     before_image=None, after_image=None):
     """
     Runs your custom YOLOv8 change detection (best.pt)
     on the stitched panoramas, saves annotated images and report.
+    Already-decoded panoramas can be passed as `before_image` / `after_image`.
     """
 
-    def analyze(image_path):
-        image = cv2.imread(image_path)
+    def analyze(image_path, image=None):
+        if image is None:
+            image = cv2.imread(image_path)
         if image is None:
             print(f"❌ Error: Could not load image {image_path}")
             return None, {}
@@ -451,14 +1981,14 @@ def run_custom_yolo_change_detection(model, before_path, after_path, output_dir,
 
         return annotated, counts
 
-    before_img, counts_before = analyze(before_path)
-    after_img, counts_after = analyze(after_path)
+    before_img, counts_before = analyze(before_path, before_image)
+    after_img, counts_after = analyze(after_path, after_image)
 
-    before_out = os.path.join(output_dir, f"{tourA}_custom_before.jpg")
-    after_out = os.path.join(output_dir, f"{tourB}_custom_after.jpg")
+    before_out = os.path.join(output_dir, f"{tourA}_custom_before.{OUTPUT_IMAGE_FORMAT}")
+    after_out = os.path.join(output_dir, f"{tourB}_custom_after.{OUTPUT_IMAGE_FORMAT}")
 
-    cv2.imwrite(before_out, before_img)
-    cv2.imwrite(after_out, after_img)
+    image_writer.submit(before_out, before_img)
+    image_writer.submit(after_out, after_img)
 
     # Compare object differences
     report = {"before": counts_before, "after": counts_after, "added": {}, "removed": {}}
@@ -482,14 +2012,237 @@ def run_custom_yolo_change_detection(model, before_path, after_path, output_dir,
             f.write(f"✅ ADDED {v}x {k}\n")
         for k, v in report["removed"].items():
             f.write(f"❌ REMOVED {v}x {k}\n")
+    artifact_store.publish(report_path)
 
     return {
-        "before_image": f"/compare_results/custom_yolo/{tourA}_custom_before.jpg",
-        "after_image": f"/compare_results/custom_yolo/{tourB}_custom_after.jpg",
+        "before_image": f"/compare_results/custom_yolo/{tourA}_custom_before.{OUTPUT_IMAGE_FORMAT}",
+        "after_image": f"/compare_results/custom_yolo/{tourB}_custom_after.{OUTPUT_IMAGE_FORMAT}",
         "report_path": f"/compare_results/custom_yolo/{tourA}_vs_{tourB}_custom_report.txt",
         "report": report,
     }
 
+
+def parse_custom_report(report_path: str):
+    """Loads a saved custom change-detection text report into structured JSON."""
+    structured_report = {"before": {}, "after": {}, "added": {}, "removed": {}}
+    with open(report_path, "r", encoding="utf-8") as f:
+        text = f.read()
+
+    # Extract sections using regex
+    before_match = re.search(r"BEFORE:\s*(\{.*?\})", text)
+    after_match = re.search(r"AFTER:\s*(\{.*?\})", text)
+    added = re.findall(r"ADDED\s+(\d+)x\s+(\w+)", text)
+    removed = re.findall(r"REMOVED\s+(\d+)x\s+(\w+)", text)
+
+    # Parse dicts from text safely
+    if before_match:
+        structured_report["before"] = ast.literal_eval(before_match.group(1))
+    if after_match:
+        structured_report["after"] = ast.literal_eval(after_match.group(1))
+    structured_report["added"] = {label: int(count) for count, label in added}
+    structured_report["removed"] = {label: int(count) for count, label in removed}
+    return structured_report
+
+
+# =========================================================
+# 🧩 Selective comparison pipeline
+# =========================================================
+# Every compare output is produced by a small graph of stages.
+# Stages are pulled lazily and memoized per request, so only the
+# stages an output actually needs are executed. SegFormer / YOLO-Seg
+# predictions are also persisted per tour (see load_prediction), so
+# overlays requested one at a time share them across requests.
+#
+#   panorama ──┬── yolo_pred ──┬── yolo
+#              │               └── combined
+#              ├── seg_map ────┬── segmentation
+#              │               └── combined
+#              └───────────────── custom_yolo (both tours)
+
+COMPARE_OUTPUTS = ("yolo", "segmentation", "combined", "custom_yolo")
+
+
+def compare_output_files(tourA: str, tourB: str):
+    """Disk paths + public URLs for every comparison output."""
+    ext = OUTPUT_IMAGE_FORMAT
+    return {
+        "yolo": {
+            "A": (os.path.join(YOLO_DIR, f"{tourA}_detected.{ext}"), f"/compare_results/yolo/{tourA}_detected.{ext}"),
+            "B": (os.path.join(YOLO_DIR, f"{tourB}_detected.{ext}"), f"/compare_results/yolo/{tourB}_detected.{ext}"),
+        },
+        "segmentation": {
+            "A": (os.path.join(SEGMENT_DIR, f"{tourA}_segmented.{ext}"), f"/compare_results/segmentation/{tourA}_segmented.{ext}"),
+            "B": (os.path.join(SEGMENT_DIR, f"{tourB}_segmented.{ext}"), f"/compare_results/segmentation/{tourB}_segmented.{ext}"),
+        },
+        "combined": {
+            "A": (os.path.join(COMBINED_DIR, f"{tourA}_combined.{ext}"), f"/compare_results/combined/{tourA}_combined.{ext}"),
+            "B": (os.path.join(COMBINED_DIR, f"{tourB}_combined.{ext}"), f"/compare_results/combined/{tourB}_combined.{ext}"),
+        },
+        "custom_yolo": {
+            "before_image": (os.path.join(CUSTOM_YOLO_DIR, f"{tourA}_custom_before.{ext}"),
+                             f"/compare_results/custom_yolo/{tourA}_custom_before.{ext}"),
+            "after_image": (os.path.join(CUSTOM_YOLO_DIR, f"{tourB}_custom_after.{ext}"),
+                            f"/compare_results/custom_yolo/{tourB}_custom_after.{ext}"),
+            "report_path": (os.path.join(CUSTOM_YOLO_DIR, f"{tourA}_vs_{tourB}_custom_report.txt"),
+                            f"/compare_results/custom_yolo/{tourA}_vs_{tourB}_custom_report.txt"),
+        },
+    }
+
+
+class ComparePipeline:
+    """
+    Dependency-aware executor for one tourA/tourB comparison.
+    `get(stage, side)` runs a stage (and only the stages it depends on)
+    at most once per request.
+    """
+
+    def __init__(self, tourA: str, tourB: str, pathA: str, pathB: str, channel: str = None):
+        self.tours = {"A": tourA, "B": tourB}
+        self.channel = channel
+        self.paths = {"A": pathA, "B": pathB}
+        self.files = compare_output_files(tourA, tourB)
+        self.memo = {}
+        self.executed = []
+
+    def get(self, stage: str, side: str = None):
+        key = (stage, side)
+        if key not in self.memo:
+            start_time = time.time()
+            self.memo[key] = PIPELINE_STAGES[stage](self, side)
+            self.executed.append(f"{stage}:{side}" if side else stage)
+            duration = time.time() - start_time
+            logging.info(f"🧩 Stage {stage}{'/' + side if side else ''} done in {duration:.2f}s")
+            progress_hub.emit(self.channel, "stage_done", stage=stage,
+                              tour=self.tours.get(side), seconds=round(duration, 2))
+        return self.memo[key]
+
+    def is_cached(self, output: str):
+        paths = [path for path, _ in self.files[output].values()]
+        if not all(image_writer.is_pending(path) or artifact_store.exists(path) for path in paths):
+            # Never generated, or evicted by the storage manager → rebuild
+            return False
+        for path in paths:
+            storage_manager.touch(path)
+        return True
+
+    def pending_images(self):
+        """URLs of requested images that are still being encoded."""
+        return [url for files in self.files.values() for path, url in files.values()
+                if image_writer.is_pending(path)]
+
+    def run(self, outputs):
+        """Produces the requested outputs, reusing files already on disk."""
+        response = {}
+        for output in outputs:
+            if self.is_cached(output):
+                logging.info(f"⚡ Using cached {output} output for {self.tours['A']} vs {self.tours['B']}")
+                response[output] = self.cached_result(output)
+            else:
+                # One node generates each output; the others wait and reuse it
+                job = f"compare-{self.tours['A']}-{self.tours['B']}-{output}"
+                result = run_single_flight(job, lambda: self.is_cached(output), lambda: self.generate(output))
+                response[output] = self.cached_result(output) if result is None else result
+
+            # Partial result: each output is usable as soon as it is ready
+            progress_hub.emit(self.channel, "output_ready", output=output, result=response[output])
+        return response
+
+    def generate(self, output: str):
+        with inference_lock:
+            if output == "custom_yolo":
+                result = self.get("custom_yolo")
+            else:
+                self.get(output, "A")
+                self.get(output, "B")
+                result = {
+                    "tourA": self.files[output]["A"][1],
+                    "tourB": self.files[output]["B"][1],
+                }
+        if artifact_store.remote:
+            # Keep the lease until other nodes can fetch the images
+            image_writer.wait([path for path, _ in self.files[output].values()])
+        return result
+
+    def cached_result(self, output: str):
+        if output != "custom_yolo":
+            return {
+                "tourA": self.files[output]["A"][1],
+                "tourB": self.files[output]["B"][1],
+            }
+
+        report_path = self.files["custom_yolo"]["report_path"][0]
+        try:
+            artifact_store.ensure_local(report_path)
+            structured_report = parse_custom_report(report_path)
+        except Exception as e:
+            print(f"⚠️ Cached report parse failed: {e}")
+            structured_report = {"before": {}, "after": {}, "added": {}, "removed": {},
+                                 "error": "Could not parse cached report"}
+        result = {name: url for name, (_, url) in self.files["custom_yolo"].items()}
+        result["report"] = structured_report
+        return result
+
+
+def _stage_panorama(pipe: ComparePipeline, side: str):
+    # Decoded once, then shared (memory-mapped) by every stage below
+    image = load_panorama(pipe.tours[side])
+    if image is None:
+        raise HTTPException(status_code=500, detail=f"Could not read panorama for {pipe.tours[side]}")
+    return image
+
+
+def _stage_yolo_pred(pipe: ComparePipeline, side: str):
+    prediction = load_prediction(pipe.tours[side], "yolo")
+    if prediction is None:
+        prediction = predict_yolo_seg(pipe.get("panorama", side))
+        cache_prediction(pipe.tours[side], "yolo", prediction)
+    return prediction
+
+
+def _stage_seg_map(pipe: ComparePipeline, side: str):
+    seg_map = load_prediction(pipe.tours[side], "segformer")
+    if seg_map is None:
+        seg_map = predict_segformer(pipe.get("panorama", side))
+        cache_prediction(pipe.tours[side], "segformer", seg_map)
+    return seg_map
+
+
+def _stage_yolo(pipe: ComparePipeline, side: str):
+    render_yolo_seg(pipe.get("panorama", side), pipe.get("yolo_pred", side), pipe.files["yolo"][side][0])
+
+
+def _stage_segmentation(pipe: ComparePipeline, side: str):
+    render_segmentation(pipe.get("panorama", side), pipe.get("seg_map", side), pipe.files["segmentation"][side][0])
+
+
+def _stage_combined(pipe: ComparePipeline, side: str):
+    render_combined(pipe.get("panorama", side), pipe.get("seg_map", side),
+                    pipe.get("yolo_pred", side), pipe.files["combined"][side][0])
+
+
+def _stage_custom_yolo(pipe: ComparePipeline, side: str = None):
+    return run_custom_yolo_change_detection(
+        model=custom_yolo_model,
+        before_path=pipe.paths["A"],
+        after_path=pipe.paths["B"],
+        output_dir=CUSTOM_YOLO_DIR,
+        tourA=pipe.tours["A"],
+        tourB=pipe.tours["B"],
+        before_image=pipe.get("panorama", "A"),
+        after_image=pipe.get("panorama", "B"),
+    )
+
+
+PIPELINE_STAGES = {
+    "panorama": _stage_panorama,
+    "yolo_pred": _stage_yolo_pred,
+    "seg_map": _stage_seg_map,
+    "yolo": _stage_yolo,
+    "segmentation": _stage_segmentation,
+    "combined": _stage_combined,
+    "custom_yolo": _stage_custom_yolo,
+}
+
 # =========================================================
 # 4️⃣ API ROUTES
 # =========================================================
@@ -503,7 +2256,7 @@ def root():
 # Upload Endpoint
 # ---------------------------------------------------------
 @app.post("/upload-image-file/{tour_id}")
-async def upload_image_file(tour_id: str, file: UploadFile = File(...)):
+def upload_image_file(tour_id: str, file: UploadFile = File(...)):
     """
     Uploads a single frame image and stores it in:
         temp_uploads/<tour_id>/<filename>
@@ -516,6 +2269,8 @@ async def upload_image_file(tour_id: str, file: UploadFile = File(...)):
         with open(file_path, "wb") as buffer:
             shutil.copyfileobj(file.file, buffer)
 
+        register_frame(tour_id, file.filename)
+        artifact_store.publish(file_path)
         logging.info(f"📸 Saved frame: {file.filename} (Tour ID: {tour_id})")
 
         image_url = f"/uploads/{tour_id}/{file.filename}"
@@ -526,29 +2281,176 @@ async def upload_image_file(tour_id: str, file: UploadFile = File(...)):
         raise HTTPException(status_code=500, detail=f"File upload failed: {e}")
 
 
+# ---------------------------------------------------------
+# Video Upload Endpoint
+# ---------------------------------------------------------
+@app.post("/upload-video/{tour_id}")
+async def upload_video(tour_id: str, request: Request, filename: str = "video.mp4"):
+    """
+    Uploads a walkthrough video, sent as the raw request body:
+        curl --data-binary @walk.mp4 "<api>/upload-video/<tour_id>?filename=walk.mp4"
+    extracts keyframes by motion + sharpness and stores them as frames of the tour:
+        temp_uploads/<tour_id>/frame-<n>.jpg
+    ready for /stitch-panorama/{tour_id}. The body is streamed straight to
+    a temporary file (a single copy on disk, nothing held in memory) and
+    decoded frame by frame once complete: containers such as MP4 may keep
+    their index at the end of the file, so decoding cannot start mid-upload.
+    The file is deleted afterwards.
+    """
+    channel = f"video-{tour_id}"
+    run = progress_hub.start(channel)
+
+    suffix = os.path.splitext(filename)[1] or ".mp4"
+    # Scratch copy lives in the system temp dir: never served under /uploads
+    # nor counted against (or evicted by) the storage quotas
+    fd, video_path = tempfile.mkstemp(prefix="video-", suffix=suffix)
+    try:
+        try:
+            with os.fdopen(fd, "wb") as buffer:
+                async for chunk in request.stream():
+                    buffer.write(chunk)
+        except Exception as e:
+            logging.error(f"❌ Video upload failed for tour {tour_id}: {e}")
+            progress_hub.finish(channel, run, "error", status_code=400, detail=f"Upload interrupted: {e}")
+            raise HTTPException(status_code=400, detail=f"Video upload failed: {e}")
+
+        size = os.path.getsize(video_path)
+        if not size:
+            progress_hub.finish(channel, run, "error", status_code=400, detail="Empty request body")
+            raise HTTPException(status_code=400, detail="Send the video as the request body.")
+        progress_hub.emit(channel, "video_received", bytes=size)
+
+        # Decoding is CPU-bound: keep it off the event loop
+        return await asyncio.get_running_loop().run_in_executor(
+            None, extract_video_frames, tour_id, video_path, channel, run)
+    finally:
+        os.remove(video_path)
+
+
+def extract_video_frames(tour_id: str, video_path: str, channel: str, run):
+    """Extracts keyframes of a received video into the tour (see upload_video)."""
+    tour_dir = os.path.join(UPLOAD_DIR, tour_id)
+    os.makedirs(tour_dir, exist_ok=True)
+
+    # Numbering continues after the tour's frames, including those on other nodes
+    get_tour_files(tour_id)
+    saved = []
+
+    def save_keyframe(frame):
+        filename = add_next_frame(tour_id, lambda path: cv2.imwrite(path, frame))
+        file_path = os.path.join(tour_dir, filename)
+        artifact_store.publish(file_path)
+        saved.append(filename)
+        progress_hub.emit(channel, "keyframe", filename=filename, imageUrl=f"/uploads/{tour_id}/{filename}")
+
+    try:
+        start_time = time.time()
+        stats = extract_keyframes(
+            video_path, save_keyframe,
+            on_event=lambda event, **data: progress_hub.emit(channel, event, **data),
+        )
+        duration = time.time() - start_time
+    except ValueError as e:
+        logging.error(f"❌ Video rejected for tour {tour_id}: {e}")
+        progress_hub.finish(channel, run, "error", status_code=400, detail=str(e))
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logging.error(f"❌ Video processing failed for tour {tour_id}: {e}")
+        progress_hub.finish(channel, run, "error", status_code=500, detail=str(e))
+        raise HTTPException(status_code=500, detail=f"Video processing failed: {e}")
+
+    if not saved:
+        progress_hub.finish(channel, run, "error", status_code=400, detail="No usable frames found in video")
+        raise HTTPException(status_code=400, detail="No usable frames found in video.")
+
+    logging.info(f"🎬 Extracted {len(saved)} keyframes from {stats['frames_decoded']} frames "
+                 f"in {duration:.2f}s (Tour ID: {tour_id})")
+    message = f"✅ Extracted {len(saved)} keyframes in {duration:.2f}s"
+    if stats["truncated"]:
+        message += f" (limit of {VIDEO_MAX_KEYFRAMES} reached, end of video skipped)"
+    result = {
+        "message": message,
+        "tour_id": tour_id,
+        "keyframes": saved,
+        "imageUrls": [f"/uploads/{tour_id}/{f}" for f in saved],
+        **stats,
+    }
+    progress_hub.finish(channel, run, "done", **result)
+    return result
+
+
 # ---------------------------------------------------------
 # Stitch Endpoint
 # ---------------------------------------------------------
-@app.post("/stitch-panorama/{tour_id}")
-async def stitch_panorama(tour_id: str):
+def build_panorama(tour_id: str):
     """
     Stitches all uploaded frames into one panorama using OpenCV.
-    Skips stitching if the panorama already exists.
+    Skips stitching if the panorama already exists (on any node), or if
+    the current frames already failed to stitch.
+    Progress is streamed on the stitch-<tour_id> channel.
     """
-    logging.info(f"🧵 Stitching requested for tour: {tour_id}")
+    channel = f"stitch-{tour_id}"
+    run = progress_hub.start(channel)
+    try:
+        result = _build_panorama(tour_id)
+    except HTTPException as e:
+        progress_hub.finish(channel, run, "error", status_code=e.status_code, detail=e.detail)
+        raise
+    except Exception as e:
+        progress_hub.finish(channel, run, "error", status_code=500, detail=str(e))
+        raise
+    progress_hub.finish(channel, run, "done", **result)
+    return result
 
-    # 🔹 1️⃣ Check if panorama already exists
+
+def _build_panorama(tour_id: str):
     output_filename = f"{tour_id}_panorama.jpg"
-    output_path = os.path.join(STITCHED_DIR, output_filename)
-    if os.path.exists(output_path):
-        logging.info(f"🖼️ Panorama already exists for {tour_id}, skipping stitching.")
-        return {
-            "message": "✅ Panorama already exists, skipping stitching.",
+    output_path = panorama_path(tour_id)
+
+    def finished():
+        """True once a result (success or failure) is recorded for the current frames."""
+        if artifact_store.exists(output_path):
+            return True
+        record = read_stitch_status(tour_id)
+        if not record or record["status"] != "failed":
+            return False
+        # Fetch frames uploaded to other nodes first: the signature must cover the same frames everywhere
+        return bool(get_tour_files(tour_id)) and record.get("frames_signature") == frames_signature(tour_id)
+
+    # 🔹 1️⃣ Stitch unless a result is already recorded
+    if not finished():
+        # Only one node stitches a tour; the others wait for its result
+        result = run_single_flight(f"stitch-{tour_id}", finished, lambda: stitch_tour(tour_id))
+        if result is not None:
+            return result
+
+    # Panoramas stitched before outcomes were recorded may be the old frame-0 fallback
+    record = read_stitch_status(tour_id) or {"status": "unknown"}
+    if record["status"] == "failed":
+        logging.info(f"⛔ Frames of {tour_id} already failed to stitch, not retrying until they change.")
+        raise HTTPException(status_code=422, detail={
+            "message": "❌ Stitching failed for the current frames. Upload more overlapping frames and retry.",
             "tour_id": tour_id,
-            "status": "exists",
-            "saved_as": output_filename,
-            "finalPanoramaUrl": f"/panoramas/{output_filename}",
-        }
+            "diagnostics": record.get("diagnostics"),
+        })
+
+    storage_manager.touch(output_path)
+    logging.info(f"🖼️ Panorama already exists for {tour_id}, skipping stitching.")
+    return {
+        "message": "✅ Panorama already exists, skipping stitching.",
+        "tour_id": tour_id,
+        "status": "exists",
+        "stitch_status": record["status"],
+        "saved_as": output_filename,
+        "finalPanoramaUrl": f"/panoramas/{output_filename}",
+        "parts": record.get("parts", []),
+    }
+
+
+def stitch_tour(tour_id: str):
+    """Loads, stitches and saves the frames of one tour (no exists check)."""
+    output_filename = f"{tour_id}_panorama.jpg"
+    output_path = panorama_path(tour_id)
 
     # 🔹 2️⃣ Load uploaded images
     image_files = get_tour_files(tour_id)
@@ -557,207 +2459,277 @@ async def stitch_panorama(tour_id: str):
         raise HTTPException(status_code=400, detail="Need at least 2 images to create a panorama.")
 
     try:
-        images = [cv2.imread(f) for f in image_files]
+        images = load_tour_frames(tour_id)
         if any(img is None for img in images):
             raise ValueError("One or more uploaded images could not be read.")
         logging.info(f"✅ Loaded {len(images)} images successfully for tour {tour_id}")
     except Exception as e:
         logging.error(f"❌ Error reading images: {e}")
         raise HTTPException(status_code=500, detail=f"Error loading images: {e}")
-
-    # 🔹 3️⃣ Stitch with OpenCV
-    stitcher = cv2.Stitcher.create(cv2.Stitcher_PANORAMA)
+    channel = f"stitch-{tour_id}"
+    progress_hub.emit(channel, "frames_loaded", count=len(images))
+
+    # 🎯 Drop blurry / duplicate frames before stitching
+    filenames = [os.path.basename(f) for f in image_files]
+    if FRAME_SELECTION:
+        kept, selection = select_frames(images, filenames)
+        images = [images[i] for i in kept]
+        logging.info(f"🎯 Using {len(images)}/{selection['total']} frames for tour {tour_id} "
+                     f"({len(selection['dropped'])} dropped)")
+    else:
+        selection = {"total": len(images), "used": filenames, "dropped": []}
+    with manifest_lock(tour_id):
+        manifest = read_tour_manifest(tour_id)
+        manifest["selection"] = selection
+        write_tour_manifest(tour_id, manifest)
+    progress_hub.emit(channel, "frames_selected", **selection)
+
+    # 👀 Low-resolution preview as soon as the frames are registered,
+    # so clients can show something while the full panorama is composed
+    preview_filename = f"{tour_id}_preview.jpg"
+
+    def show_preview(image, **data):
+        image_writer.write(os.path.join(STITCHED_DIR, preview_filename), image)
+        progress_hub.emit(channel, "preview", url=f"/panoramas/{preview_filename}", **data)
+
+    # 🔹 3️⃣ Stitch with OpenCV (retry ladder)
     start_time = time.time()
-    status, stitched_image = stitcher.stitch(images)
+    outcome, panoramas, diagnostics = stitch_with_fallbacks(
+        images, selection["used"],
+        on_event=lambda event, **data: progress_hub.emit(channel, event, **data),
+        on_preview=show_preview,
+    )
     duration = time.time() - start_time
-    logging.info(f"🕒 Stitch completed in {duration:.2f}s (Status: {status})")
+    logging.info(f"🕒 Stitch completed in {duration:.2f}s (Outcome: {outcome}, "
+                 f"{len(diagnostics['attempts'])} attempts)")
+
+    record = {
+        "status": outcome,
+        "frames_signature": frames_signature(tour_id),
+        "stitched_at": datetime.now().isoformat(timespec="seconds"),
+        "duration_s": round(duration, 2),
+        "parts": [],
+        "diagnostics": diagnostics,
+    }
 
-    if status != cv2.Stitcher_OK:
-        logging.warning(f"⚠️ Stitching failed (Status: {status}). Using first frame as fallback.")
-        stitched_image = images[0]
+    if outcome == "failed":
+        # Recorded (not cached as a panorama) so callers get the diagnostics
+        write_stitch_status(tour_id, record)
+        logging.error(f"❌ Every stitching strategy failed for {tour_id}")
+        raise HTTPException(status_code=422, detail={
+            "message": "❌ Stitching failed for the current frames. Upload more overlapping frames and retry.",
+            "tour_id": tour_id,
+            "diagnostics": diagnostics,
+        })
+
+    # 🔹 4️⃣ Save the panorama (largest result) + partial panoramas
+    stitched_image = panoramas[0][1]
 
-    # 🔹 4️⃣ Save the panorama
     try:
+        if outcome == "partial":
+            for k, (segment, pano) in enumerate(panoramas, start=1):
+                part_filename = f"{tour_id}_panorama_part{k}.jpg"
+                part_path = os.path.join(STITCHED_DIR, part_filename)
+                cv2.imwrite(part_path, pano)
+                artifact_store.publish(part_path)
+                record["parts"].append({
+                    "url": f"/panoramas/{part_filename}",
+                    "frames": [selection["used"][i] for i in segment],
+                })
+        write_stitch_status(tour_id, record)
+
         cv2.imwrite(output_path, stitched_image)
+        cache_panorama(tour_id, stitched_image)
+        artifact_store.publish(output_path)
         logging.info(f"💾 Panorama successfully saved to: {output_path}")
+        progress_hub.emit(channel, "stitch_done", url=f"/panoramas/{output_filename}",
+                          outcome=outcome, parts=record["parts"])
     except Exception as e:
         logging.error(f"❌ Error saving stitched panorama: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to save panorama: {e}")
 
+    # 🗜️ Frames are no longer needed loose once the panorama exists
+    if STORAGE_COMPACT_FRAMES:
+        compact_tour_frames(tour_id)
+    storage_manager.enforce_in_background()
+
     # 🔹 5️⃣ Return result
+    if outcome == "partial":
+        message = f"⚠️ Stitched {len(panoramas)} partial panoramas in {duration:.2f}s"
+    else:
+        message = f"✅ Stitching completed in {duration:.2f}s"
 
     return {
-        "message": f"✅ Stitching completed in {duration:.2f}s",
+        "message": message,
         "tour_id": tour_id,
-        "status": int(status),
+        "status": int(cv2.Stitcher_OK),
+        "stitch_status": outcome,
         "saved_as": output_filename,
         "finalPanoramaUrl": f"/panoramas/{output_filename}",
+        "parts": record["parts"],
+        "frames": selection,
+        "diagnostics": diagnostics,
     }
 
 
+@app.post("/stitch-panorama/{tour_id}")
+def stitch_panorama(tour_id: str):
+    """Stitches the uploaded frames of a tour (see build_panorama)."""
+    logging.info(f"🧵 Stitching requested for tour: {tour_id}")
+    return build_panorama(tour_id)
+
+
 # ---------------------------------------------------------
 # Compare Tours Endpoint
 # ---------------------------------------------------------
 class CompareRequest(BaseModel):
     tourA: str
     tourB: str
+    # Subset of COMPARE_OUTPUTS to produce (default: all of them)
+    outputs: Optional[List[str]] = None
     
 @app.post("/compare-tours-ai")
-async def compare_tours_ai(data: CompareRequest):
-    pathA = os.path.join(STITCHED_DIR, f"{data.tourA}_panorama.jpg")
-    pathB = os.path.join(STITCHED_DIR, f"{data.tourB}_panorama.jpg")
+def compare_tours_ai(data: CompareRequest):
+    # Validate the request before any (possibly minutes long) re-stitching
+    outputs = list(COMPARE_OUTPUTS) if data.outputs is None else data.outputs
+    if not outputs:
+        raise HTTPException(status_code=400, detail=f"No outputs requested. Choose from {list(COMPARE_OUTPUTS)}")
+    unknown = [o for o in outputs if o not in COMPARE_OUTPUTS]
+    if unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown outputs {unknown}. Choose from {list(COMPARE_OUTPUTS)}",
+        )
 
-    if not os.path.exists(pathA) or not os.path.exists(pathB):
+    pathA = panorama_path(data.tourA)
+    pathB = panorama_path(data.tourB)
+
+    # ♻️ Re-stitch panoramas the storage manager evicted (frames are kept)
+    for tour_id, path in ((data.tourA, pathA), (data.tourB, pathB)):
+        if not artifact_store.exists(path) and get_tour_files(tour_id):
+            build_panorama(tour_id)
+
+    if not artifact_store.exists(pathA) or not artifact_store.exists(pathB):
         raise HTTPException(status_code=400, detail="One or both panoramas not found")
 
-    # Expected output paths
-    yolo_A_path = os.path.join(YOLO_DIR, f"{data.tourA}_detected.jpg")
-    yolo_B_path = os.path.join(YOLO_DIR, f"{data.tourB}_detected.jpg")
-    seg_A_path = os.path.join(SEGMENT_DIR, f"{data.tourA}_segmented.jpg")
-    seg_B_path = os.path.join(SEGMENT_DIR, f"{data.tourB}_segmented.jpg")
-    combined_A_path = os.path.join(COMBINED_DIR, f"{data.tourA}_combined.jpg")
-    combined_B_path = os.path.join(COMBINED_DIR, f"{data.tourB}_combined.jpg")
-    report_path = os.path.join(CUSTOM_YOLO_DIR, f"{data.tourA}_vs_{data.tourB}_custom_report.txt")
-
-    # ✅ Check if outputs already exist (cache system)
-    all_exist = all(
-        os.path.exists(p)
-        for p in [
-            yolo_A_path,
-            yolo_B_path,
-            seg_A_path,
-            seg_B_path,
-            combined_A_path,
-            combined_B_path,
-            report_path,
-        ]
-    )
+    # 🧠 Run only the stages the requested outputs depend on
+    channel = f"compare-{data.tourA}-{data.tourB}"
+    run = progress_hub.start(channel)
+    pipeline = ComparePipeline(data.tourA, data.tourB, pathA, pathB, channel=channel)
+    try:
+        results = pipeline.run(outputs)
+    except Exception as e:
+        progress_hub.finish(channel, run, "error", detail=getattr(e, "detail", str(e)))
+        raise
+    progress_hub.finish(channel, run, "done", stages_run=pipeline.executed, outputs=outputs)
 
-    if all_exist:
+    if pipeline.executed:
+        message = "✅ Compare complete with YOLO + Segmentation"
+    else:
         print("⚡ Skipping regeneration — using cached AI comparison results.")
+        message = "✅ Using cached comparison results"
 
-        # Load cached text and convert into structured JSON report
-        cached_text = ""
-        structured_report = {
-             "before": {},
-             "after": {},
-             "added": {},
-             "removed": {}
-        }
-
-        try:
-            with open(report_path, "r", encoding="utf-8") as f:
-                cached_text = f.read()
-            # Extract sections using regex
-            before_match = re.search(r"BEFORE:\s*(\{.*?\})", cached_text)
-            after_match = re.search(r"AFTER:\s*(\{.*?\})", cached_text)
-            added = re.findall(r"ADDED\s+(\d+)x\s+(\w+)", cached_text)
-            removed = re.findall(r"REMOVED\s+(\d+)x\s+(\w+)", cached_text)
-            
-             # Parse dicts from text safely
-            if before_match:
-                structured_report["before"] = ast.literal_eval(before_match.group(1))
-            if after_match:
-                structured_report["after"] = ast.literal_eval(after_match.group(1))
-            structured_report["added"] = {label: int(count) for count, label in added}
-            structured_report["removed"] = {label: int(count) for count, label in removed}
-            
-        except Exception as e:
-            print(f"⚠️ Cached report parse failed: {e}")
-            structured_report["error"] = "Could not parse cached report"
-
-        return {
-            "message": "✅ Using cached comparison results",
-            "yolo": {
-                "tourA": f"/compare_results/yolo/{data.tourA}_detected.jpg",
-                "tourB": f"/compare_results/yolo/{data.tourB}_detected.jpg",
-            },
-            "segmentation": {
-                "tourA": f"/compare_results/segmentation/{data.tourA}_segmented.jpg",
-                "tourB": f"/compare_results/segmentation/{data.tourB}_segmented.jpg",
-            },
-            "combined": {
-                "tourA": f"/compare_results/combined/{data.tourA}_combined.jpg",
-                "tourB": f"/compare_results/combined/{data.tourB}_combined.jpg",
-            },
-            "custom_yolo": {
-                "before_image": f"/compare_results/custom_yolo/{data.tourA}_custom_before.jpg",
-                "after_image": f"/compare_results/custom_yolo/{data.tourB}_custom_after.jpg",
-                "report_path": f"/compare_results/custom_yolo/{data.tourA}_vs_{data.tourB}_custom_report.txt",
-                "report": structured_report,
-            },
-        }
-
-    # 🧠 If not cached — generate everything fresh
-    print("🧩 Generating new AI comparison results...")
-
-    # YOLO Seg
-    run_yolo_seg(pathA, yolo_A_path)
-    run_yolo_seg(pathB, yolo_B_path)
-
-    # SegFormer
-    run_segmentation(pathA, seg_A_path)
-    run_segmentation(pathB, seg_B_path)
-
-    # Combined
-    run_combined_segformer_yoloseg(pathA, combined_A_path)
-    run_combined_segformer_yoloseg(pathB, combined_B_path)
-
-    # Custom YOLO (change detection)
-    custom_result = run_custom_yolo_change_detection(
-        model=custom_yolo_model,
-        before_path=pathA,
-        after_path=pathB,
-        output_dir=CUSTOM_YOLO_DIR,
-        tourA=data.tourA,
-        tourB=data.tourB,
-    )
+    storage_manager.enforce_in_background()
 
     return {
-        "message": "✅ Compare complete with YOLO + Segmentation",
-        "yolo": {
-            "tourA": f"/compare_results/yolo/{data.tourA}_detected.jpg",
-            "tourB": f"/compare_results/yolo/{data.tourB}_detected.jpg",
-        },
-        "segmentation": {
-            "tourA": f"/compare_results/segmentation/{data.tourA}_segmented.jpg",
-            "tourB": f"/compare_results/segmentation/{data.tourB}_segmented.jpg",
-        },
-        "combined": {
-            "tourA": f"/compare_results/combined/{data.tourA}_combined.jpg",
-            "tourB": f"/compare_results/combined/{data.tourB}_combined.jpg",
-        },
-        "custom_yolo": custom_result
+        "message": message,
+        "stages_run": pipeline.executed,
+        "pending_images": pipeline.pending_images(),
+        **results,
     }
 
 
 
 @app.get("/compare_results/{filename}")
-async def get_compare_result(filename: str):
+def get_compare_result(filename: str):
     file_path = os.path.join(COMPARE_DIR, filename)
-    if not os.path.exists(file_path):
+    if not artifact_store.ensure_local(file_path):
         raise HTTPException(status_code=404, detail="Diff image not found")
     return FileResponse(file_path)
 
 
+# ---------------------------------------------------------
+# Progress Stream Endpoints (SSE)
+# ---------------------------------------------------------
+@app.get("/progress/stitch/{tour_id}")
+async def stitch_progress(tour_id: str, request: Request):
+    """Live stitch events: frames_loaded → frames_selected → features_matched → preview → stitch_attempt… → stitch_done → done."""
+    return sse_response(f"stitch-{tour_id}", request)
+
+
+@app.get("/progress/video/{tour_id}")
+async def video_progress(tour_id: str, request: Request):
+    """Live video ingestion events: video_received → keyframe (each) → done."""
+    return sse_response(f"video-{tour_id}", request)
+
+
+@app.get("/progress/compare/{tourA}/{tourB}")
+async def compare_progress(tourA: str, tourB: str, request: Request):
+    """Live compare events: stage_done / output_ready per model, then done."""
+    return sse_response(f"compare-{tourA}-{tourB}", request)
+
+
+# ---------------------------------------------------------
+# Storage Admin Endpoints
+# ---------------------------------------------------------
+@app.get("/admin/storage")
+def storage_usage():
+    """Usage, quota and artifact counts for every storage folder."""
+    return {
+        "compact_frames": STORAGE_COMPACT_FRAMES,
+        "min_age_s": STORAGE_MIN_AGE_S,
+        "folders": storage_manager.usage(),
+    }
+
+
+@app.post("/admin/storage/enforce")
+def enforce_storage_quotas():
+    """Runs LRU eviction now and returns what was removed."""
+    evicted = storage_manager.enforce()
+    return {
+        "evicted": evicted,
+        "freed_bytes": sum(item["size"] for item in evicted),
+        "folders": storage_manager.usage(),
+    }
+
+
+@app.post("/admin/storage/compact/{tour_id}")
+def compact_frames(tour_id: str):
+    """Packs a stitched tour's frames into a single archive."""
+    if not artifact_store.exists(panorama_path(tour_id)):
+        raise HTTPException(status_code=400, detail="Stitch the tour before compacting its frames")
+    return {"tour_id": tour_id, "compacted_frames": compact_tour_frames(tour_id)}
+
+
 # ---------------------------------------------------------
 # Generate report pdf
 # ---------------------------------------------------------
 
 @app.post("/generate-pdf-report")
-async def generate_pdf_report(data: CompareRequest):
+def generate_pdf_report(data: CompareRequest):
     tourA, tourB = data.tourA, data.tourB
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
+    # --- Make sure every output the PDF embeds exists (cached ones cost nothing) ---
+    pathA = panorama_path(tourA)
+    pathB = panorama_path(tourB)
+    if artifact_store.exists(pathA) and artifact_store.exists(pathB):
+        ComparePipeline(tourA, tourB, pathA, pathB).run(COMPARE_OUTPUTS)
+
     # --- Paths ---
-    before_img = os.path.join(COMPARE_DIR, "custom_yolo", f"{tourA}_custom_before.jpg")
-    after_img = os.path.join(COMPARE_DIR, "custom_yolo", f"{tourB}_custom_after.jpg")
-    yolo_imgA = os.path.join(COMPARE_DIR, "yolo", f"{tourA}_detected.jpg")
-    yolo_imgB = os.path.join(COMPARE_DIR, "yolo", f"{tourB}_detected.jpg")
-    seg_imgA = os.path.join(COMPARE_DIR, "segmentation", f"{tourA}_segmented.jpg")
-    seg_imgB = os.path.join(COMPARE_DIR, "segmentation", f"{tourB}_segmented.jpg")
-    combined_imgA = os.path.join(COMPARE_DIR, "combined", f"{tourA}_combined.jpg")
-    combined_imgB = os.path.join(COMPARE_DIR, "combined", f"{tourB}_combined.jpg")
+    files = compare_output_files(tourA, tourB)
+    before_img = files["custom_yolo"]["before_image"][0]
+    after_img = files["custom_yolo"]["after_image"][0]
+    yolo_imgA, yolo_imgB = files["yolo"]["A"][0], files["yolo"]["B"][0]
+    seg_imgA, seg_imgB = files["segmentation"]["A"][0], files["segmentation"]["B"][0]
+    combined_imgA, combined_imgB = files["combined"]["A"][0], files["combined"]["B"][0]
+
+    # Images may still be encoding in the background, or live on another node
+    pdf_images = [before_img, after_img, yolo_imgA, yolo_imgB,
+                  seg_imgA, seg_imgB, combined_imgA, combined_imgB]
+    image_writer.wait(pdf_images)
+    for path in pdf_images:
+        artifact_store.ensure_local(path)
 
     # --- Create PDF folder ---
     PDF_DIR = os.path.join(COMPARE_DIR, "pdf")
@@ -768,18 +2740,8 @@ async def generate_pdf_report(data: CompareRequest):
     report_path = os.path.join(COMPARE_DIR, "custom_yolo", f"{tourA}_vs_{tourB}_custom_report.txt")
     structured_report = {"before": {}, "after": {}, "added": {}, "removed": {}}
     try:
-        with open(report_path, "r", encoding="utf-8") as f:
-            text = f.read()
-        before_match = re.search(r"BEFORE:\s*(\{.*?\})", text)
-        after_match = re.search(r"AFTER:\s*(\{.*?\})", text)
-        added = re.findall(r"ADDED\s+(\d+)x\s+(\w+)", text)
-        removed = re.findall(r"REMOVED\s+(\d+)x\s+(\w+)", text)
-        if before_match:
-            structured_report["before"] = ast.literal_eval(before_match.group(1))
-        if after_match:
-            structured_report["after"] = ast.literal_eval(after_match.group(1))
-        structured_report["added"] = {label: int(count) for count, label in added}
-        structured_report["removed"] = {label: int(count) for count, label in removed}
+        artifact_store.ensure_local(report_path)
+        structured_report = parse_custom_report(report_path)
     except Exception as e:
         structured_report["error"] = f"Could not parse report: {e}"
 
@@ -853,6 +2815,7 @@ async def generate_pdf_report(data: CompareRequest):
 
     # --- SAVE ---
     pdf.output(pdf_path)
+    artifact_store.publish(pdf_path)
     print(f"📄 Professional PDF Report generated: {pdf_path}")
     return FileResponse(pdf_path, media_type="application/pdf", filename=os.path.basename(pdf_path))
 # =========================================================
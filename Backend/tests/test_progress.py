@@ -0,0 +1,62 @@
+import pytest
+
+# main.py loads the models at import time: run from Backend/ with the full environment
+main = pytest.importorskip("main")
+
+
+def events(hub, channel, cursor):
+    new, done = hub.read(channel, cursor)
+    return [ev["event"] for ev in new], done
+
+
+def test_subscriber_during_run_gets_replay():
+    hub = main.ProgressHub(keep_s=600)
+    run = hub.start("stitch-t1")
+    hub.emit("stitch-t1", "frames_loaded")
+
+    cursor = hub.subscribe("stitch-t1")
+    assert events(hub, "stitch-t1", cursor) == (["started", "frames_loaded"], False)
+
+    hub.finish("stitch-t1", run, "done")
+    assert events(hub, "stitch-t1", cursor) == (["done"], True)
+
+
+def test_finished_run_is_not_replayed_to_new_subscribers():
+    hub = main.ProgressHub(keep_s=600)
+    first = hub.start("compare-a-b")
+    hub.emit("compare-a-b", "stage_done")
+    hub.finish("compare-a-b", first, "done")
+
+    # Subscribed before POSTing the next compare of the same pair
+    cursor = hub.subscribe("compare-a-b")
+    assert events(hub, "compare-a-b", cursor) == ([], False)
+
+    second = hub.start("compare-a-b")
+    assert second != first
+    assert events(hub, "compare-a-b", cursor) == (["started"], False)
+    hub.finish("compare-a-b", second, "done")
+    assert events(hub, "compare-a-b", cursor) == (["done"], True)
+
+
+def test_subscriber_before_first_run():
+    hub = main.ProgressHub(keep_s=600)
+    cursor = hub.subscribe("video-t1")
+    assert events(hub, "video-t1", cursor) == ([], False)
+
+    run = hub.start("video-t1")
+    hub.finish("video-t1", run, "done")
+    assert events(hub, "video-t1", cursor) == (["started", "done"], True)
+
+
+def test_joined_run_is_kept_and_only_its_owner_finishes_it():
+    hub = main.ProgressHub(keep_s=600)
+    owner = hub.start("stitch-t1")
+    hub.emit("stitch-t1", "frames_loaded")
+
+    assert hub.start("stitch-t1") is None
+    hub.finish("stitch-t1", None, "done")
+
+    cursor = hub.subscribe("stitch-t1")
+    assert events(hub, "stitch-t1", cursor) == (["started", "frames_loaded"], False)
+    hub.finish("stitch-t1", owner, "done")
+    assert events(hub, "stitch-t1", cursor) == (["done"], True)